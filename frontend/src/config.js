@@ -1,2 +1,3 @@
 export const hostName = process.env.REACT_APP_HOSTNAME;
 export const refreshTimeout = process.env.REACT_APP_REFRESH_TIMEOUT;
+export const streaming = process.env.REACT_APP_STREAMING === "true";
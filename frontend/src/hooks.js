@@ -1,5 +1,5 @@
 import { useState, useEffect, useRef, useCallback } from "react";
-import {hostName, refreshTimeout} from "./config";
+import {hostName, refreshTimeout, streaming} from "./config";
 
 
 const mergeState = (oldState, newState) => {
@@ -75,6 +75,43 @@ export const fetchEndpoint = (uri, options) => (
     })
 );
 
+// Poll an endpoint, resolves the data (null if the server is busy) and the delay until the next poll
+export const pollEndpoint = (uri, options) => (
+    fetch(`${hostName}${uri}`, options).catch((error) => {
+      console.log("GOt Error", error);
+    }).then(async (response) => {
+      if(!response){
+        throw {
+          error: "Server not available",
+        };
+      }
+
+      // The server sheds load, keep the current state and come back later
+      if(response.status === 503){
+        return [null, (parseInt(response.headers.get("Retry-After")) || 1) * 1000];
+      }
+      if(response.status === 401){
+        throw response;
+      }
+
+      const delay = parseInt(response.headers.get("X-Poll-Interval")) || refreshTimeout;
+      return [await response.json(), delay];
+    })
+);
+
+// Subscribe to the server sent events of an endpoint, returns the unsubscribe function
+export const subscribeEndpoint = (uri, onData, onClose) => {
+  const source = new EventSource(`${hostName}${uri}`);
+  source.onmessage = (event) => onData(JSON.parse(event.data));
+  source.onerror = () => {
+    // The browser reconnects by itself unless the server refused the stream
+    if(source.readyState === EventSource.CLOSED && onClose){
+      onClose();
+    }
+  };
+  return () => source.close();
+};
+
 export const useLocalStorage = (initialState) => {
   const [state, setStateInner] = useState(() => initialState ?? JSON.parse(window.localStorage.getItem(localStorageKey)));
 
@@ -118,13 +155,19 @@ export const useScreen = () => {
 
   let gameName = "Test";
   useEffect(() => {
+    if(streaming){
+      return subscribeEndpoint(`/api/${gameName}/stream?role=screen`, setState);
+    }
+
     let running = true;
     const func = () => {
-        fetchEndpoint(`/api/${gameName}/`).then(
-        (data) => {
-          setState(data);
+        pollEndpoint(`/api/${gameName}/`).then(
+        ([data, delay]) => {
+          if(data){
+            setState(data);
+          }
           if(running){
-            setTimeout(func, refreshTimeout);
+            setTimeout(func, delay);
           }
         }
       );
@@ -160,21 +203,34 @@ export const useTeam = (gameName, name) => {
     if(!teamToken){
       return;
     }
+    if(streaming){
+      return subscribeEndpoint(
+        `/api/${gameName}/stream?role=team&token=${encodeURIComponent(teamToken)}`,
+        setTeamData,
+        () => {
+          setTeamData(null);
+          setLocalStorage((data) => ({...data, teamToken: undefined}));
+        },
+      );
+    }
+
     let running = true;
     const func = () => {
-      fetchEndpoint(`/api/${gameName}/team`, {
+      pollEndpoint(`/api/${gameName}/team`, {
         headers: {"Authorization": `Bearer ${teamToken}`},
-      }).catch((response) => {
-        setTeamData(null);
-        setLocalStorage((data) => ({...data, teamToken: undefined}));
       }).then(
-        (data) => {
-          setTeamData(data);
+        ([data, delay]) => {
+          if(data){
+            setTeamData(data);
+          }
           if(running){
-            setTimeout(func, refreshTimeout);
+            setTimeout(func, delay);
           }
         }
-      );
+      ).catch((response) => {
+        setTeamData(null);
+        setLocalStorage((data) => ({...data, teamToken: undefined}));
+      });
     };
 
     func();
@@ -202,6 +258,7 @@ export const useTeam = (gameName, name) => {
 export const useGameMaster = (password) => {
   const [gameMasterToken, setGameMasterToken] = useState(null);
   const [quizData, setQuizData] = useMergedState(null);
+  const quiz = useRef({hash: null, questions: null});
 
   let gameName = "Test";
   useEffect(() => {
@@ -225,16 +282,38 @@ export const useGameMaster = (password) => {
     }
 
     let gameName = "Test";
+
+    // The quiz is only fetched again once its hash changes
+    const setWithQuiz = async (data) => {
+      if(data?.quiz_hash && data.quiz_hash !== quiz.current.hash){
+        const questions = await fetchEndpoint(`/api/${gameName}/quiz/${data.quiz_hash}`, {
+          headers: {"Authorization": `Bearer ${gameMasterToken}`},
+        });
+        quiz.current = {hash: data.quiz_hash, questions};
+      }
+      setQuizData({...data, questions: quiz.current.questions});
+    };
+
+    if(streaming){
+      return subscribeEndpoint(
+        `/api/${gameName}/stream?role=gamemaster&token=${encodeURIComponent(gameMasterToken)}`,
+        setWithQuiz,
+        () => setGameMasterToken(null),
+      );
+    }
+
     let running = true;
     const func = () => {
-      fetchEndpoint(`/api/${gameName}/gamemaster`, {
+      pollEndpoint(`/api/${gameName}/gamemaster`, {
         headers: {"Authorization": `Bearer ${gameMasterToken}`},
       }).then(
-        (data) => {
-          setQuizData(data);
+        async ([data, delay]) => {
+          if(data){
+            await setWithQuiz(data);
+          }
 
           if(running){
-            setTimeout(func, refreshTimeout);
+            setTimeout(func, delay);
           }
         }
       ).catch((response) => {
@@ -1,4 +1,4 @@
-import {useState, useCallback} from "react";
+import {useState, useCallback, useEffect} from "react";
 import {useTeam, useGameMaster, useScreen} from "./hooks";
 import {BaseTeamRenderer, QuestionRenderer} from "./renderer";
 
@@ -127,6 +127,24 @@ export const ShowEmotions = ({showEmotion, currentEmotion}) => (
 );
 
 
+// Seconds left until the deadline (unix time) of a timed question
+export const Countdown = ({deadline, questionState}) => {
+  const [now, setNow] = useState(Date.now() / 1000);
+  useEffect(() => {
+    if(!deadline || questionState !== "ASK"){
+      return;
+    }
+    const interval = setInterval(() => setNow(Date.now() / 1000), 250);
+    return () => clearInterval(interval);
+  }, [deadline, questionState]);
+
+  if(!deadline || questionState !== "ASK"){
+    return null;
+  }
+  return <div className="Countdown">{Math.max(0, Math.ceil(deadline - now))}</div>;
+};
+
+
 export const TeamSeat = () => {
   const [preName, setPreName] = useState("");
   const [name, setName] = useState("");
@@ -161,6 +179,7 @@ export const TeamSeat = () => {
       &nbsp;
       <span>{state.title}: {state.game_state} {state.question_state}</span>
     </div>
+    <Countdown deadline={state.deadline} questionState={state.question_state}/>
     {state?.game_state === "PLAY"
       && (state?.question_state === "ASK" ||
         state?.question_state === "ANSWER" || state?.question_state === "SCORE")
@@ -184,6 +203,7 @@ export const ScreenSeat = () => {
   const state = useScreen();
 
   return <div className="App Candidate">
+    <Countdown deadline={state?.deadline} questionState={state?.question_state}/>
     {state?.game_state === "PLAY"
       && (state?.question_state === "ASK" || state?.question_state === "SCORE" ||
         state?.question_state === "ANSWER")
@@ -197,7 +217,9 @@ export const ScreenSeat = () => {
       <div className="Start">{state?.name}</div>
     )}
     <div className="EmotionFooter">
-      {Object.entries(state?.emotion_data || {}).map(([team, emotion]) => emotion).join("")}
+      {Object.entries(state?.emotion_counts || {}).map(([emotion, count]) => (
+        <span className="Emotion" key={emotion}>{emotion}{count > 1 && <sub>{count}</sub>}</span>
+      ))}
     </div>
   </div>
 };
@@ -1,3 +1,4 @@
 from .main import run_tool
 
-run_tool()
+if __name__ == "__main__":
+    run_tool()
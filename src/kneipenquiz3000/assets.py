@@ -0,0 +1,111 @@
+"""
+Serving of the bundled frontend.
+
+All files are read and gzipped once at startup. Files whose name already
+carries a content hash (the build output in `static/`) are cached forever
+by clients. Other files are referenced from `index.html` with their
+content hash appended as `?v=`, so they can be cached forever as well,
+while `index.html` itself is always revalidated.
+"""
+import re
+import gzip
+import hashlib
+import mimetypes
+from pathlib import Path
+from aiohttp import web
+from .logs import logger
+
+
+# Matches the content hash in build file names like `main.d4f5e668.js`
+_re_hashed_name = re.compile(r"\.[0-9a-f]{8}\.")
+
+COMPRESSIBLE_TYPES = ("text/", "application/javascript", "application/json", "image/svg+xml")
+GZIP_MIN_SIZE = 256
+
+# Source maps of the build
+mimetypes.add_type("application/json", ".map")
+
+IMMUTABLE = "public, max-age=31536000, immutable"
+REVALIDATE = "no-cache"
+
+
+class Asset:
+    def __init__(self, url, body, content_type, hashed):
+        self.url = url
+        self.body = body
+        self.content_type = content_type
+        self.hashed = hashed
+        self.digest = hashlib.sha256(body).hexdigest()[:16]
+        self.etag = f'"{self.digest}"'
+        self.gzipped = None
+
+        if len(body) >= GZIP_MIN_SIZE and content_type.startswith(COMPRESSIBLE_TYPES):
+            gzipped = gzip.compress(body, 9)
+            if len(gzipped) < len(body):
+                self.gzipped = gzipped
+
+    @property
+    def versioned_url(self):
+        return self.url if self.hashed else f"{self.url}?v={self.digest}"
+
+    def response(self, request):
+        immutable = self.hashed or request.query.get("v") == self.digest
+        headers = {
+            "ETag": self.etag,
+            "Cache-Control": IMMUTABLE if immutable else REVALIDATE,
+            "Vary": "Accept-Encoding",
+        }
+
+        if self.etag in request.headers.get("If-None-Match", ""):
+            raise web.HTTPNotModified(headers=headers)
+
+        body = self.body
+        if self.gzipped is not None and "gzip" in request.headers.get("Accept-Encoding", ""):
+            body = self.gzipped
+            headers["Content-Encoding"] = "gzip"
+
+        return web.Response(body=body, headers=headers, content_type=self.content_type)
+
+
+class AssetManifest:
+    def __init__(self, root, index="index.html"):
+        self.root = Path(root)
+        self.assets = {}
+
+        for path in sorted(self.root.rglob("*")):
+            if not path.is_file():
+                continue
+            url = "/" + path.relative_to(self.root).as_posix()
+            content_type = mimetypes.guess_type(path.name)[0] or "application/octet-stream"
+            hashed = bool(_re_hashed_name.search(path.name))
+            self.assets[url] = Asset(url, path.read_bytes(), content_type, hashed)
+
+        # Point the index to the versioned urls of unhashed files
+        index_url = f"/{index}"
+        index_asset = self.assets[index_url]
+        html = index_asset.body.decode("utf8")
+        for asset in self.assets.values():
+            if asset is not index_asset and not asset.hashed:
+                html = html.replace(f'"{asset.url}"', f'"{asset.versioned_url}"')
+        self.index = self.assets[index_url] = Asset(index_url, html.encode("utf8"), index_asset.content_type, False)
+
+        logger.info(
+            "Prepared %s frontend assets, %s bytes (%s bytes gzipped)",
+            len(self.assets),
+            sum(len(asset.body) for asset in self.assets.values()),
+            sum(len(asset.gzipped or asset.body) for asset in self.assets.values()),
+        )
+
+    async def handle(self, request):
+        path = request.match_info["path"]
+        if not path:
+            return self.index.response(request)
+
+        try:
+            asset = self.assets["/" + path]
+        except KeyError:
+            raise web.HTTPNotFound()
+        return asset.response(request)
+
+    def add_routes(self, app):
+        app.router.add_get("/{path:.*}", self.handle)
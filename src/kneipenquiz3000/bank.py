@@ -0,0 +1,290 @@
+"""
+Question banks.
+
+A bank keeps a large pool of questions in one file (`<name>.kq3b`) that is
+opened with mmap, so the pool lives in the page cache shared by all
+processes instead of being loaded into each of them. `kneipenquiz3000 bank`
+builds it from json line files with one question per line, the questions
+as in a quiz plus an optional `category` and `difficulty`.
+
+Layout of the file, integers little endian:
+
+    header      magic, version, record count, offsets and index position
+    records     marshal dumps of the questions, as in compiled quizzes
+    offsets     uint64 start of every record plus the end of the last one
+    index       marshal dump of the category and renderer names and the
+                groups (category, difficulty, renderer, first, end)
+
+The records are sorted by category, difficulty and renderer, so every
+group is a contiguous range of record numbers and sampling only needs
+the small group table.
+
+A quiz file with a `bank` entry is sampled from the bank named by it
+(relative to the quiz) instead of listing its questions:
+
+    {"name": ..., "startTitle": ..., "bank": "pool.kq3b", "blocks": [
+        {"startTitle": ..., "count": 10, "category": "history",
+         "difficulty": [1, 3], "renderer": "base"}
+    ]}
+
+Each game gets its own sample, a question is decoded only when it's asked.
+"""
+import json
+import mmap
+import hashlib
+import struct
+import marshal
+from pathlib import Path
+import numpy as np
+from .states import Quiz, QuestionBlock, Question
+from .compiled import _dump_question, _load_question
+
+
+MAGIC = b"KQ3B"
+FORMAT_VERSION = 2
+SUFFIX = ".kq3b"
+
+_HEADER = struct.Struct("<4sIIQQQ")
+
+DEFAULT_CATEGORY = "general"
+
+
+def _iter_sources(paths):
+    """Yield the question json of json line files and of the blocks of quiz files"""
+    for path in paths:
+        path = Path(path)
+        with open(path) as f:
+            if path.suffix == ".json":
+                data = json.load(f)
+                for block in data.get("blocks", []):
+                    for question in block.get("questions", []):
+                        yield {"category": block.get("startTitle", DEFAULT_CATEGORY), **question}
+                continue
+
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
+
+def build_bank(sources, output):
+    """Build a bank from question files, skipping invalid questions
+
+    Returns the number of stored questions and the list of errors.
+    """
+    categories = {}
+    renderers = {}
+    records = []
+    errors = []
+
+    for number, data in enumerate(_iter_sources(sources)):
+        try:
+            question = Question.from_json(data)
+            difficulty = int(data.get("difficulty", 0))
+        except (KeyError, ValueError, TypeError) as e:
+            errors.append(f"Question {number + 1}: Could not be parsed: {e!r}")
+            continue
+
+        problems = question.validate()
+        if problems:
+            errors.extend(f"Question {number + 1} ({question.title}): {problem}" for problem in problems)
+            continue
+
+        category = categories.setdefault(str(data.get("category", DEFAULT_CATEGORY)), len(categories))
+        renderer = renderers.setdefault(question.renderer, len(renderers))
+        records.append(((category, difficulty, renderer), marshal.dumps(_dump_question(question))))
+
+    records.sort(key=lambda record: record[0])
+
+    offsets = np.zeros(len(records) + 1, dtype="<u8")
+    groups = []
+    position = _HEADER.size
+    for number, (key, record) in enumerate(records):
+        if not groups or tuple(groups[-1][:3]) != key:
+            groups.append([*key, number, number])
+        groups[-1][4] = number + 1
+        offsets[number] = position
+        position += len(record)
+    offsets[-1] = position
+
+    # The offsets are 8 byte aligned to be used straight from the mapping
+    padding = -position % 8
+    offsets_position = position + padding
+    index_position = offsets_position + offsets.nbytes
+    index = marshal.dumps((
+        tuple(categories), tuple(renderers), tuple(tuple(group) for group in groups),
+    ))
+
+    tmp_path = Path(output).with_suffix(".tmp")
+    with open(tmp_path, "wb") as f:
+        f.write(_HEADER.pack(MAGIC, FORMAT_VERSION, marshal.version, len(records), offsets_position, index_position))
+        for _, record in records:
+            f.write(record)
+        f.write(b"\0" * padding)
+        f.write(offsets.tobytes())
+        f.write(index)
+    tmp_path.replace(output)
+    return len(records), errors
+
+
+class QuestionBank:
+    def __init__(self, path):
+        self.path = Path(path)
+        with open(self.path, "rb") as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, marshal_version, count, offsets_position, index_position = \
+            _HEADER.unpack_from(self._map)
+        if magic != MAGIC or (version, marshal_version) != (FORMAT_VERSION, marshal.version):
+            raise ValueError(f"{self.path} is not a question bank of this version")
+
+        self.count = count
+        self.offsets = np.frombuffer(self._map, dtype="<u8", count=count + 1, offset=offsets_position)
+        self.categories, self.renderers, groups = marshal.loads(self._map[index_position:])
+        groups = np.array(groups, dtype=np.int64).reshape(-1, 5)
+        self._group_category, self._group_difficulty, self._group_renderer, \
+            self._group_start, self._group_end = groups.T
+
+    def __len__(self):
+        return self.count
+
+    def record(self, record):
+        """The encoded question stored as record number `record`"""
+        return self._map[self.offsets[record]:self.offsets[record + 1]]
+
+    def question(self, record):
+        """Decode the question stored as record number `record`"""
+        return _load_question(marshal.loads(self.record(record)))
+
+    def _groups(self, category=None, difficulty=None, renderer=None):
+        selected = np.ones(len(self._group_start), dtype=bool)
+        if category is not None:
+            if category not in self.categories:
+                return np.flatnonzero(selected[:0])
+            selected &= self._group_category == self.categories.index(category)
+        if renderer is not None:
+            if renderer not in self.renderers:
+                return np.flatnonzero(selected[:0])
+            selected &= self._group_renderer == self.renderers.index(renderer)
+        if difficulty is not None:
+            if isinstance(difficulty, (list, tuple)):
+                low, high = difficulty
+                selected &= (self._group_difficulty >= low) & (self._group_difficulty <= high)
+            else:
+                selected &= self._group_difficulty == difficulty
+        return np.flatnonzero(selected)
+
+    def available(self, category=None, difficulty=None, renderer=None):
+        groups = self._groups(category, difficulty, renderer)
+        return int((self._group_end[groups] - self._group_start[groups]).sum())
+
+    def sample(self, count, category=None, difficulty=None, renderer=None, exclude=(), rng=None):
+        """Record numbers of up to `count` distinct random questions matching the filter
+
+        :param difficulty: A difficulty or an inclusive `[low, high]` range
+        :param exclude: Record numbers not to pick, e.g. those of earlier blocks
+        """
+        rng = rng or np.random.default_rng()
+        groups = self._groups(category, difficulty, renderer)
+        starts = self._group_start[groups]
+        sizes = self._group_end[groups] - starts
+        ends = np.cumsum(sizes)
+        total = int(ends[-1]) if len(ends) else 0
+
+        # Picking a few more leaves enough once the excluded ones are dropped
+        picks = rng.choice(total, size=min(count + len(exclude), total), replace=False)
+        group = np.searchsorted(ends, picks, side="right")
+        records = starts[group] + picks - (ends[group] - sizes[group])
+        return [int(record) for record in records if record not in exclude][:count]
+
+
+_banks = {}
+
+
+def open_bank(path):
+    """Open a bank once per process, all quizzes of it share the mapping"""
+    path = Path(path).resolve()
+    mtime = path.stat().st_mtime_ns
+    try:
+        bank_mtime, bank = _banks[path]
+        if bank_mtime == mtime:
+            return bank
+    except KeyError:
+        pass
+
+    bank = QuestionBank(path)
+    _banks[path] = (mtime, bank)
+    return bank
+
+
+class BankQuiz(Quiz):
+    """A quiz of questions sampled from a bank, decoded once they're accessed"""
+    def __init__(self, name, title, bank, blocks, counts=None):
+        super().__init__(name, title, [
+            QuestionBlock(block_title, records, decode=bank.question)
+            for block_title, records in blocks
+        ])
+        self.bank = bank
+        # Record numbers of the questions of each block, to restore the quiz
+        self.records = [list(records) for _, records in blocks]
+        # Questions asked for per block, the bank may have had fewer
+        self.counts = counts
+
+    @property
+    def digest(self):
+        # Hashed from the encoded records, without decoding them
+        if self._digest is None:
+            digest = hashlib.sha256(marshal.dumps((self.name, self.title, tuple(block.title for block in self.blocks))))
+            for records in self.records:
+                for record in records:
+                    digest.update(self.bank.record(record))
+            self._digest = digest.hexdigest()[:20]
+        return self._digest
+
+    def _validate(self):
+        # The questions were validated when the bank was built, checking
+        # them again would decode all of them
+        errors = []
+        for block_index, (block, count) in enumerate(zip(self.blocks, self.counts or ())):
+            if 0 < len(block) < count:
+                errors.append(
+                    f"Block {block_index + 1} ({block.title}): Only {len(block)} of {count} questions match in the bank"
+                )
+        return errors
+
+
+class BankQuizSpec:
+    """The blocks of a quiz sampled from a bank, see the module documentation"""
+    def __init__(self, name, title, bank, blocks):
+        self.name = name
+        self.title = title
+        self.bank = bank
+        self.blocks = blocks
+
+    @classmethod
+    def from_json(cls, data, directory="."):
+        bank = open_bank(Path(directory) / data["bank"])
+        blocks = [{
+            "title": block.get("startTitle", "Block Title"),
+            "count": int(block.get("count", 10)),
+            "category": block.get("category"),
+            "difficulty": block.get("difficulty"),
+            "renderer": block.get("renderer"),
+        } for block in data.get("blocks", [])]
+        return cls(data.get("name", "Quiz Name"), data.get("startTitle", "Title"), bank, blocks)
+
+    def sample(self, records=None, rng=None):
+        """A new quiz, from the given record numbers of each block if not `None`"""
+        if records is None:
+            records = []
+            used = set()
+            for block in self.blocks:
+                picked = self.bank.sample(
+                    block["count"], block["category"], block["difficulty"], block["renderer"],
+                    exclude=used, rng=rng,
+                )
+                used.update(picked)
+                records.append(picked)
+
+        return BankQuiz(self.name, self.title, self.bank, [
+            (block["title"], block_records) for block, block_records in zip(self.blocks, records)
+        ], counts=[block["count"] for block in self.blocks])
@@ -0,0 +1,221 @@
+"""
+Load test simulating a pub night against the real app.
+
+The game server runs in process on a local port. Teams, screens and a
+gamemaster follow the same protocol as the frontend: teams join, poll
+their state, guess once per question and now and then show an emotion,
+screens poll the game, the gamemaster steps through the questions.
+
+The result is plain json with sorted keys, so results of two versions can
+be diffed.
+"""
+import json
+import time
+import argparse
+import random
+import asyncio
+import numpy as np
+import aiohttp
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+from .states import Game
+
+
+EMOTIONS = ["😀", "😂", "🥲", "🤩"]
+
+
+class Recorder:
+    def __init__(self):
+        self.latencies = {}
+        self.errors = {}
+        self.handler_time = 0
+
+    def add(self, name, latency, ok):
+        self.latencies.setdefault(name, []).append(latency)
+        if not ok:
+            self.errors[name] = self.errors.get(name, 0) + 1
+
+    @web.middleware
+    async def middleware(self, request, handler):
+        # The handlers run on the same loop, this is the server side share
+        start = time.perf_counter()
+        try:
+            return await handler(request)
+        finally:
+            self.handler_time += time.perf_counter() - start
+
+    def route_stats(self):
+        stats = {}
+        for name, latencies in self.latencies.items():
+            latencies = np.array(latencies) * 1000
+            p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+            stats[name] = {
+                "count": len(latencies),
+                "errors": self.errors.get(name, 0),
+                "mean_ms": round(float(latencies.mean()), 3),
+                "p50_ms": round(float(p50), 3),
+                "p95_ms": round(float(p95), 3),
+                "p99_ms": round(float(p99), 3),
+                "max_ms": round(float(latencies.max()), 3),
+            }
+        return stats
+
+
+class Client:
+    def __init__(self, session, base, recorder, game_key):
+        self.session = session
+        self.base = f"{base}/api/{game_key}"
+        self.recorder = recorder
+        self.headers = {}
+
+    async def request(self, method, path="/", data=None):
+        start = time.perf_counter()
+        ok = False
+        result = None
+        try:
+            async with self.session.request(
+                method, self.base + path, headers=self.headers,
+                data=None if data is None else json.dumps(data),
+            ) as response:
+                result = await response.json() if response.status == 200 else None
+                ok = response.status < 400
+        finally:
+            self.recorder.add(f"{method} {path}", time.perf_counter() - start, ok)
+        return result
+
+    def authorize(self, token):
+        self.headers = {"Authorization": f"Bearer {token}"}
+
+
+async def simulate_team(client, index, poll_interval, running):
+    token = await client.request("PUT", "/join_team", {"name": f"Team {index}"})
+    client.authorize(token)
+    guessed = None
+
+    while running.is_set():
+        state = await client.request("GET", "/team")
+
+        question = state and state["question_data"]
+        if question and state["question_state"] == "ASK" and guessed != state["current_question_index"]:
+            # Think a bit before answering
+            await asyncio.sleep(random.random() * poll_interval)
+            if question["renderer"] == "guess":
+                answer = round(random.uniform(question["min"], question["max"]))
+            else:
+                answer = random.randrange(max(len(question["answers"]), 1))
+            await client.request("PUT", "/team/guess", answer)
+            guessed = state["current_question_index"]
+
+        if random.random() < 0.05:
+            await client.request("PUT", "/team/show_emotion", random.choice(EMOTIONS))
+
+        await asyncio.sleep(poll_interval)
+
+
+async def simulate_screen(client, poll_interval, running):
+    while running.is_set():
+        await client.request("GET", "/")
+        await asyncio.sleep(poll_interval)
+
+
+async def simulate_gamemaster(client, password, questions, answer_time, poll_interval):
+    client.authorize(await client.request("PUT", "/join_gamemaster", password))
+
+    async def action(name, data=None):
+        await client.request("PUT", f"/gamemaster/{name}", data)
+
+    async def watch(seconds):
+        for _ in range(max(int(seconds / poll_interval), 1)):
+            await client.request("GET", "/gamemaster")
+            await asyncio.sleep(poll_interval)
+
+    await action("start_game")
+    for _ in range(questions):
+        await action("ask_next_question")
+        await action("set_screen_state", "QUESTION")
+        await watch(answer_time)
+        await action("score_answer")
+        await watch(poll_interval)
+        await action("show_answer")
+        await action("set_screen_state", "ANSWER")
+        await watch(answer_time / 2)
+    await action("set_screen_state", "FINAL")
+    await action("end_game")
+
+
+async def run_bench(quiz_path, teams=50, screens=2, questions=5, answer_time=5, poll_interval=0.5, seed=0):
+    random.seed(seed)
+    recorder = Recorder()
+
+    # The app as served, see `commands.create_app`
+    from .commands import Serve, create_app
+    game_key = "bench"
+    password = "bench"
+    parser = argparse.ArgumentParser()
+    Serve.get_arguments(parser)
+    app = create_app(parser.parse_args(["--quiz", str(quiz_path), "--name", game_key, "--password", password]))
+    # Outermost, to time the whole stack
+    app.middlewares.insert(0, recorder.middleware)
+    questions = min(questions, len(Game.get_game(game_key).questions))
+
+    server = TestServer(app)
+    await server.start_server()
+    base = str(server.make_url("")).rstrip("/")
+    running = asyncio.Event()
+    running.set()
+
+    try:
+        async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=0)) as session:
+            def client():
+                return Client(session, base, recorder, game_key)
+
+            start = time.perf_counter()
+            cpu_start = time.process_time()
+
+            tasks = [
+                asyncio.ensure_future(simulate_team(client(), index, poll_interval, running))
+                for index in range(teams)
+            ] + [
+                asyncio.ensure_future(simulate_screen(client(), poll_interval, running))
+                for _ in range(screens)
+            ]
+            # Give the teams a moment to join
+            await asyncio.sleep(poll_interval)
+            await simulate_gamemaster(client(), password, questions, answer_time, poll_interval)
+
+            running.clear()
+            await asyncio.gather(*tasks)
+
+            duration = time.perf_counter() - start
+            cpu = time.process_time() - cpu_start
+    finally:
+        await server.close()
+        Game.remove_game(Game.get_game(game_key))
+
+    route_stats = recorder.route_stats()
+    requests = sum(stats["count"] for stats in route_stats.values())
+    return {
+        "config": {
+            "quiz": str(quiz_path),
+            "teams": teams,
+            "screens": screens,
+            "questions": questions,
+            "answer_time": answer_time,
+            "poll_interval": poll_interval,
+            "seed": seed,
+        },
+        "duration_s": round(duration, 3),
+        "requests": requests,
+        "errors": sum(stats["errors"] for stats in route_stats.values()),
+        "throughput_rps": round(requests / duration, 1),
+        "cpu": {
+            "process_s": round(cpu, 3),
+            "process_utilization": round(cpu / duration, 3),
+            "server_handlers_s": round(recorder.handler_time, 3),
+        },
+        "routes": route_stats,
+    }
+
+
+def dump_result(result):
+    return json.dumps(result, indent=2, sort_keys=True, ensure_ascii=False)
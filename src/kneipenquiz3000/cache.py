@@ -0,0 +1,141 @@
+"""
+Cache of encoded role views.
+
+Views are keyed by game and role and stay valid as long as the game
+version doesn't change, so any number of clients polling the same state
+cost a single serialization. The gzip variant is only built once a client
+asks for it.
+"""
+import zlib
+import time
+from .views import encode, encode_team_fragment, encode_team_view, quiz_view
+from .metrics import metrics
+
+
+# Bodies smaller than this are not worth compressing
+GZIP_MIN_SIZE = 1024
+GZIP_LEVEL = 6
+
+# Views projected with `?fields=` kept per game, the oldest ones are dropped
+MAX_PROJECTIONS = 32
+
+
+def _gzip_compressor():
+    return zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+
+
+class CacheEntry:
+    def __init__(self, cache, version, body):
+        self.cache = cache
+        self.version = version
+        self.body = body
+        self._gzipped = None
+        self._prefix = None
+
+    @property
+    def gzipped(self):
+        if self._gzipped is None:
+            self.cache.gzip_misses += 1
+            compressor = _gzip_compressor()
+            self._gzipped = compressor.compress(self.body) + compressor.flush()
+        else:
+            self.cache.gzip_hits += 1
+        return self._gzipped
+
+    def _get_prefix(self):
+        """Compress the shared part of team views once
+
+        Returns the output produced so far and the compressor state, which
+        can be copied to append the team fragment.
+        """
+        if self._prefix is None:
+            compressor = _gzip_compressor()
+            self._prefix = (compressor.compress(self.body[:-1]), compressor)
+        return self._prefix
+
+    def team_body(self, team):
+        return encode_team_view(self.body, team)
+
+    def team_gzipped(self, team):
+        output, compressor = self._get_prefix()
+        compressor = compressor.copy()
+        return output + compressor.compress(encode_team_fragment(team)) + compressor.flush()
+
+
+class ViewCache:
+    def __init__(self):
+        self.entries = {}
+        # Cache roles of the projected views per game key, oldest first
+        self.projections = {}
+        self.hits = 0
+        self.misses = 0
+        self.gzip_hits = 0
+        self.gzip_misses = 0
+
+    def get(self, game, role, build, version=None):
+        """Return the cache entry of a role view, building it if outdated
+
+        Entries are valid for one game version unless another `version` is
+        given.
+        """
+        if version is None:
+            version = game.version
+        key = (game.key, role)
+        entry = self.entries.get(key)
+
+        if entry is not None and entry.version == version:
+            self.hits += 1
+            return entry
+
+        self.misses += 1
+        if entry is None and "?fields=" in role:
+            self._add_projection(game, role)
+        start = time.perf_counter()
+        body = encode(build(game))
+        metrics.serialization.observe(time.perf_counter() - start)
+        entry = self.entries[key] = CacheEntry(self, version, body)
+        return entry
+
+    def _add_projection(self, game, role):
+        # Any subset of the fields can be asked for, only the latest are kept
+        roles = self.projections.setdefault(game.key, {})
+        roles[role] = None
+        if len(roles) > MAX_PROJECTIONS:
+            oldest = next(iter(roles))
+            del roles[oldest]
+            self.entries.pop((game.key, oldest), None)
+
+    def quiz(self, game):
+        # The quiz never changes during a game
+        return self.get(game, "quiz", quiz_view, version=0)
+
+    def discard(self, game):
+        for key in [key for key in self.entries if key[0] == game.key]:
+            del self.entries[key]
+        self.projections.pop(game.key, None)
+
+    def stats(self):
+        return {
+            "entries": len(self.entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "gzip_hits": self.gzip_hits,
+            "gzip_misses": self.gzip_misses,
+        }
+
+    def metric_samples(self):
+        yield "# TYPE quiz_view_cache_entries gauge"
+        yield f"quiz_view_cache_entries {len(self.entries)}"
+        yield "# TYPE quiz_view_cache_lookups_total counter"
+        yield f'quiz_view_cache_lookups_total{{result="hit"}} {self.hits}'
+        yield f'quiz_view_cache_lookups_total{{result="miss"}} {self.misses}'
+        yield f'quiz_view_cache_lookups_total{{result="gzip_hit"}} {self.gzip_hits}'
+        yield f'quiz_view_cache_lookups_total{{result="gzip_miss"}} {self.gzip_misses}'
+
+
+view_cache = ViewCache()
+metrics.add_collector(view_cache.metric_samples)
+
+
+def gamemaster_view(game):
+    return {**game.gamemaster_data, "quiz_hash": game.questions.digest}
@@ -0,0 +1,281 @@
+"""
+Column wise storage of team state.
+
+All teams of a game live in one `TeamStore`, one row per team in join
+order, so scoring and the aggregated views work on whole arrays instead of
+looping over `Team` objects. `Team` only keeps its row index.
+
+The answers to the current question are additionally aggregated as they
+come in, see `AnswerAggregate`, and the teams are kept ranked by score,
+see `Leaderboard`. The emotions shown lately are counted in an
+`EmotionWindow`.
+"""
+import time
+from bisect import bisect_left, insort
+from collections import Counter, deque
+import numpy as np
+
+
+# Seconds emotions are counted for in `EmotionWindow`
+EMOTION_WINDOW = 30
+
+INT64_MIN, INT64_MAX = np.iinfo(np.int64).min, np.iinfo(np.int64).max
+
+
+class AnswerAggregate:
+    """Answers of the present teams to the current question
+
+    Counts the answers per option and, for questions with a target to
+    guess, keeps the guesses ordered by their distance to it (ties in join
+    order).
+    """
+    def __init__(self, options=0, target=None):
+        self.answered = 0
+        self.counts = np.zeros(options, dtype=np.int64)
+        self.target = target
+        # Sorted `(distance, row)` pairs
+        self.distances = []
+
+    def _distance(self, store, row):
+        value = store.answer_value[row]
+        if self.target is None or np.isnan(value):
+            return None
+        return (abs(float(value) - self.target), row)
+
+    def add(self, store, row):
+        if store.answers[row] is None:
+            return
+        self.answered += 1
+        option = store.answer_index[row]
+        if 0 <= option < len(self.counts):
+            self.counts[option] += 1
+        if (distance := self._distance(store, row)) is not None:
+            insort(self.distances, distance)
+
+    def discard(self, store, row):
+        if store.answers[row] is None:
+            return
+        self.answered -= 1
+        option = store.answer_index[row]
+        if 0 <= option < len(self.counts):
+            self.counts[option] -= 1
+        if (distance := self._distance(store, row)) is not None:
+            del self.distances[bisect_left(self.distances, distance)]
+
+    def closest(self, count):
+        """Rows of the `count` closest guesses, closest first"""
+        return [row for _, row in self.distances[:count]]
+
+
+class EmotionWindow:
+    """Counts of the emotions shown in the last `window` seconds
+
+    The emotions are counted in buckets of one second, which are dropped
+    again once they leave the window.
+    """
+    def __init__(self, window=EMOTION_WINDOW):
+        self.window = window
+        self.buckets = deque()
+        self.counts = Counter()
+
+    def add(self, emotion, now=None):
+        second = int(now if now is not None else time.monotonic())
+        self.expire(second)
+        if not self.buckets or self.buckets[-1][0] != second:
+            self.buckets.append((second, Counter()))
+        self.buckets[-1][1][emotion] += 1
+        self.counts[emotion] += 1
+
+    def expire(self, now=None):
+        """Drop the buckets that left the window, `True` if the counts changed"""
+        horizon = int(now if now is not None else time.monotonic()) - self.window
+        if not self.buckets or self.buckets[0][0] > horizon:
+            return False
+
+        while self.buckets and self.buckets[0][0] <= horizon:
+            self.counts.subtract(self.buckets.popleft()[1])
+        # Drops the emotions that are down to zero
+        self.counts = +self.counts
+        return True
+
+    def data(self):
+        return dict(self.counts)
+
+
+class Leaderboard:
+    """Rows of the present teams ordered by score, best first, ties in join order"""
+    # Above this many changed scores the order is rebuilt instead of updated
+    REBUILD_THRESHOLD = 64
+
+    def __init__(self):
+        # Sorted `(-score, row)` pairs
+        self.keys = []
+
+    def __len__(self):
+        return len(self.keys)
+
+    def add(self, row, score):
+        insort(self.keys, (-int(score), row))
+
+    def discard(self, row, score):
+        del self.keys[bisect_left(self.keys, (-int(score), row))]
+
+    def rebuild(self, rows, scores):
+        self.keys = sorted(zip((-scores).tolist(), rows.tolist()))
+
+    def rank(self, score):
+        """Rank of a score, teams with the same score share their rank"""
+        return bisect_left(self.keys, (-int(score), -1)) + 1
+
+    def position(self, row, score):
+        return bisect_left(self.keys, (-int(score), row))
+
+    def rows(self, start, stop):
+        return [row for _, row in self.keys[max(start, 0):stop]]
+
+
+class TeamStore:
+    def __init__(self, capacity=16):
+        self.size = 0
+        self.capacity = capacity
+
+        # Whether the team still takes part in the game
+        self.present = np.zeros(capacity, dtype=bool)
+        self.active = np.zeros(capacity, dtype=bool)
+        # The current answer parsed as answer index and as number
+        self.answer_index = np.full(capacity, -1, dtype=np.int64)
+        self.answer_value = np.full(capacity, np.nan)
+        # NaN while unscored
+        self.answer_score = np.full(capacity, np.nan)
+        self.score = np.zeros(capacity, dtype=np.int64)
+
+        # Json values are kept as they came in
+        self.names = []
+        self.answers = []
+        self.emotions = []
+
+        self.aggregate = AnswerAggregate()
+        self.leaderboard = Leaderboard()
+
+    def __len__(self):
+        return int(self.present[:self.size].sum())
+
+    def _grow(self):
+        capacity = self.capacity * 2
+
+        def grow(array, fill):
+            grown = np.full(capacity, fill, dtype=array.dtype)
+            grown[:self.capacity] = array
+            return grown
+
+        self.present = grow(self.present, False)
+        self.active = grow(self.active, False)
+        self.answer_index = grow(self.answer_index, -1)
+        self.answer_value = grow(self.answer_value, np.nan)
+        self.answer_score = grow(self.answer_score, np.nan)
+        self.score = grow(self.score, 0)
+        self.capacity = capacity
+
+    def add(self, team):
+        """Append a row for a newly joined `team`"""
+        if self.size == self.capacity:
+            self._grow()
+        index = self.size
+        self.size += 1
+
+        self.names.append(team.name)
+        self.present[index] = True
+        self.active[index] = True
+        self.answers.append(None)
+        self.emotions.append(None)
+
+        team.store = self
+        team.index = index
+        self.aggregate.add(self, index)
+        self.leaderboard.add(index, self.score[index])
+
+    def remove(self, team):
+        if self.present[team.index]:
+            self.aggregate.discard(self, team.index)
+            self.leaderboard.discard(team.index, self.score[team.index])
+        self.present[team.index] = False
+
+    def set_score(self, index, score):
+        present = self.present[index]
+        if present:
+            self.leaderboard.discard(index, self.score[index])
+        self.score[index] = score
+        if present:
+            self.leaderboard.add(index, score)
+
+    def set_answer(self, index, answer):
+        # Parsed first, the row and the aggregate must not be left half updated
+        try:
+            answer_index = int(answer)
+            if not INT64_MIN <= answer_index <= INT64_MAX:
+                answer_index = -1
+        except (TypeError, ValueError, OverflowError):
+            answer_index = -1
+
+        try:
+            answer_value = float(answer)
+        except (TypeError, ValueError, OverflowError):
+            answer_value = np.nan
+
+        present = self.present[index]
+        if present:
+            self.aggregate.discard(self, index)
+        self.answers[index] = answer
+        self.answer_index[index] = answer_index
+        self.answer_value[index] = answer_value
+        if present:
+            self.aggregate.add(self, index)
+
+    def reset_answers(self, options=0, target=None):
+        """Clear the answers for a new question
+
+        :param options: Number of answer options of the question
+        :param target: Number to guess, if any
+        """
+        self.answers[:] = [None] * self.size
+        self.answer_index[:self.size] = -1
+        self.answer_value[:self.size] = np.nan
+        self.aggregate = AnswerAggregate(options, target)
+
+    def reward(self, rewards):
+        """Add an array of rewards to the scores and clear the answer scores"""
+        size = self.size
+        rewards = np.where(self.present[:size], rewards, 0)
+        changed = np.flatnonzero(rewards)
+
+        if len(changed) > Leaderboard.REBUILD_THRESHOLD:
+            self.score[:size] += rewards
+            rows = np.flatnonzero(self.present[:size])
+            self.leaderboard.rebuild(rows, self.score[rows])
+        else:
+            for row in changed.tolist():
+                self.set_score(row, self.score[row] + rewards[row])
+        self.answer_score[:size] = 0
+
+    def current_rewards(self):
+        return np.nan_to_num(self.answer_score[:self.size]).astype(np.int64)
+
+    def _rows(self):
+        return np.flatnonzero(self.present[:self.size]).tolist()
+
+    def column_data(self, column):
+        """Map team names to the values of a column"""
+        if isinstance(column, np.ndarray):
+            column = column.tolist()
+        return {self.names[row]: column[row] for row in self._rows()}
+
+    def answer_score_data(self):
+        scores = self.answer_score[:self.size]
+        return self.column_data([None if np.isnan(score) else int(score) for score in scores])
+
+    def ranking(self, rows):
+        """Leaderboard entries of rows"""
+        return [
+            {"rank": self.leaderboard.rank(self.score[row]), "name": self.names[row], "score": int(self.score[row])}
+            for row in rows
+        ]
@@ -1,13 +1,66 @@
 from aiohttp import web
 import aiohttp_cors
+import asyncio
+import argparse
 import secrets
 from ackermann import Command
 from pathlib import Path
-from .states import Game, Quiz
+from .states import Game, Quiz, InvalidQuizException
 from .server import routes
+from .hosting import QuizLibrary, game_evictor
+from .journal import JournalManager
+from .compiled import compile_quiz
+from .bank import build_bank
+from .assets import AssetManifest
+from .bench import run_bench, dump_result
+from .microbench import run_microbench, compare, load_baseline, dump_baseline
+from .shards import run_sharded
+from .metrics import metrics
+from .load import limiter
+from .ingest import expire_emotions
+from .timers import wheel, deadlines
+from .tokens import signer
+from .profiling import Watchdog
+from .logs import logger, setup_logging, CATEGORIES
 from importlib.resources import files
 
 
+def category_value(value):
+    """Parse `CATEGORY=NUMBER` of the log sampling flags"""
+    category, _, number = value.partition("=")
+    if category not in CATEGORIES:
+        raise argparse.ArgumentTypeError(f"Unknown log category {category}, one of {', '.join(CATEGORIES)}")
+    try:
+        return category, int(number)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"Expected {category}=<number>, got {value}")
+
+
+def setup_serve_logging(args):
+    setup_logging(
+        args.log_level,
+        samples=dict(args.log_sample),
+        # 0 lifts the limit
+        rates={category: rate or None for category, rate in args.log_rate},
+    )
+
+
+def load_token_secret(journal_dir=None):
+    """A random token secret, kept in the journal directory so resumed games keep their sessions"""
+    if journal_dir is None:
+        return secrets.token_urlsafe(32)
+
+    path = journal_dir / "token_secret"
+    try:
+        return path.read_text().strip()
+    except FileNotFoundError:
+        secret = secrets.token_urlsafe(32)
+        journal_dir.mkdir(parents=True, exist_ok=True)
+        path.touch(mode=0o600)
+        path.write_text(secret)
+        return secret
+
+
 class Serve(Command):
     name = "serve"
 
@@ -25,8 +78,12 @@ class Serve(Command):
         parser.add_argument(
             "-c", "--devcors", help="Allow cors request for any host", action="store_true"
         )
-        parser.add_argument(
-            "-q", "--quiz", help="Path to quiz file", type=Path, required=True
+        quiz_group = parser.add_mutually_exclusive_group(required=True)
+        quiz_group.add_argument(
+            "-q", "--quiz", help="Path to quiz file", type=Path
+        )
+        quiz_group.add_argument(
+            "-d", "--quiz-dir", help="Directory of quiz files to create games from on demand", type=Path
         )
         parser.add_argument(
             "-n", "--name", help="Quiz name"
@@ -34,45 +91,279 @@ class Serve(Command):
         parser.add_argument(
             "-P", "--password", help="Gamemaster password"
         )
+        parser.add_argument(
+            "-A", "--admin-password", help="Password for creating games (with --quiz-dir)"
+        )
+        parser.add_argument(
+            "--idle-ttl", help="Seconds after which idle games are evicted", type=float, default=3600
+        )
+        parser.add_argument(
+            "--results-dir", help="Directory to store the final scores of evicted games", type=Path
+        )
+        parser.add_argument(
+            "-j", "--journal-dir", help="Directory to journal all game actions to", type=Path
+        )
+        parser.add_argument(
+            "-r", "--resume", help="Resume the games journaled in --journal-dir", action="store_true"
+        )
+        parser.add_argument(
+            "-w", "--workers", help="Number of worker processes games are sharded across", type=int, default=1
+        )
+        parser.add_argument(
+            "--watchdog", help="Log the stack whenever the event loop is blocked for longer than this many seconds", type=float
+        )
+        parser.add_argument(
+            "--token-secret", help="Secret signing the session tokens, shared by all servers of a game "
+            "(by default stored in --journal-dir or random)"
+        )
+        parser.add_argument(
+            "--max-inflight", help="Answer 503 once this many requests are in flight", type=int
+        )
+        parser.add_argument(
+            "--log-level", help="Level of the quiz logs", choices=["DEBUG", "INFO", "WARNING", "ERROR"], type=str.upper
+        )
+        parser.add_argument(
+            "--log-sample", help="Only log every Nth record of a category (guess, emotion, access), as CATEGORY=N",
+            type=category_value, action="append", default=[],
+        )
+        parser.add_argument(
+            "--log-rate", help="Log at most N records per second of a category, as CATEGORY=N (0 for no limit)",
+            type=category_value, action="append", default=[],
+        )
+
+    def run(self, config):
+        args = config["ARGS"]
+        setup_serve_logging(args)
+
+        # Generate passwords up front so all workers share them
+        if args.quiz_dir and not args.admin_password:
+            args.admin_password = secrets.token_urlsafe(10)
+            logger.warning("Admin password: %s", args.admin_password)
+        if args.quiz and not args.password:
+            args.password = secrets.token_urlsafe(10)
+        if not args.token_secret:
+            args.token_secret = load_token_secret(args.journal_dir)
+
+        if args.workers > 1:
+            run_sharded(args)
+        else:
+            web.run_app(create_app(args), host=args.host, port=args.port)
+
+
+class Compile(Command):
+    name = "compile"
+
+    @classmethod
+    def get_arguments(cls, parser):
+        parser.add_argument(
+            "quizzes", help="Paths to quiz files", type=Path, nargs="+"
+        )
+        parser.add_argument(
+            "--check", help="Only validate the quizzes", action="store_true"
+        )
+
+    def run(self, config):
+        args = config["ARGS"]
+        failed = False
+
+        for path in args.quizzes:
+            try:
+                quiz, errors = compile_quiz(path, write=not args.check)
+            except (OSError, ValueError, KeyError, TypeError) as e:
+                print(f"{path}: Could not be parsed: {e!r}")
+                failed = True
+                continue
+
+            for error in errors:
+                print(f"{path}: {error}")
+            failed = failed or bool(errors)
+
+            if not errors:
+                print(f"{path}: {len(quiz)} questions ok")
+
+        if failed:
+            raise SystemExit(1)
+
+
+class Bank(Command):
+    name = "bank"
+
+    @classmethod
+    def get_arguments(cls, parser):
+        parser.add_argument(
+            "sources", help="Json line files of questions or quiz files", type=Path, nargs="+"
+        )
+        parser.add_argument(
+            "-o", "--output", help="Path of the question bank", type=Path, required=True
+        )
 
     def run(self, config):
         args = config["ARGS"]
+        count, errors = build_bank(args.sources, args.output)
+        for error in errors:
+            print(error)
+        print(f"{args.output}: {count} questions, {len(errors)} skipped")
 
-        app = web.Application()
 
-        # Add cors setting for dev mode
-        if args.devcors:
-            cors = aiohttp_cors.setup(app, defaults={
-               "*": aiohttp_cors.ResourceOptions(
-                    allow_credentials=True,
-                    expose_headers="*",
-                    allow_headers="*"
-                )
-              })
+class Bench(Command):
+    name = "bench"
 
-        # Initialize frontend routes
-        # TODO maybe add cache key for easy nginx caching
-        if args.frontend:
-            static_files = files("kneipenquiz3000.frontend")
+    @classmethod
+    def get_arguments(cls, parser):
+        parser.add_argument(
+            "-q", "--quiz", help="Path to quiz file", type=Path, required=True
+        )
+        parser.add_argument(
+            "-t", "--teams", help="Number of simulated teams", type=int, default=50
+        )
+        parser.add_argument(
+            "-s", "--screens", help="Number of simulated screens", type=int, default=2
+        )
+        parser.add_argument(
+            "-n", "--questions", help="Number of questions to play", type=int, default=5
+        )
+        parser.add_argument(
+            "--answer-time", help="Seconds teams have to answer", type=float, default=5
+        )
+        parser.add_argument(
+            "--poll-interval", help="Seconds between two polls of a client", type=float, default=0.5
+        )
+        parser.add_argument(
+            "--seed", help="Seed for the random answers", type=int, default=0
+        )
+        parser.add_argument(
+            "-o", "--output", help="Write the json result to this file", type=Path
+        )
 
-            @routes.get("/")
-            async def handle(request):
-                return web.FileResponse(static_files / "index.html")
+    def run(self, config):
+        args = config["ARGS"]
+        result = asyncio.run(run_bench(
+            args.quiz, teams=args.teams, screens=args.screens, questions=args.questions,
+            answer_time=args.answer_time, poll_interval=args.poll_interval, seed=args.seed,
+        ))
 
-            routes.static('/', static_files._paths[0])
+        output = dump_result(result)
+        if args.output:
+            args.output.write_text(output + "\n")
+        print(output)
 
-        # Initialize routes
-        app.add_routes(routes)
 
-        if args.devcors:
-            for route in list(app.router.routes()):
-                cors.add(route)
+class Microbench(Command):
+    name = "microbench"
 
+    @classmethod
+    def get_arguments(cls, parser):
+        parser.add_argument(
+            "-b", "--baseline", help="Baseline file to compare against", type=Path
+        )
+        parser.add_argument(
+            "-t", "--tolerance", help="Allowed slowdown against the baseline (0.2 is 20%%)", type=float, default=0.2
+        )
+        parser.add_argument(
+            "-u", "--update", help="Write the results as new baseline", action="store_true"
+        )
+        parser.add_argument(
+            "-k", "--select", help="Only run benchmarks whose name contains this", action="append"
+        )
+
+    def run(self, config):
+        args = config["ARGS"]
+        baseline = {}
+        if args.baseline and args.baseline.exists() and not args.update:
+            baseline = load_baseline(args.baseline)
+
+        results = run_microbench(args.select)
+        regressions = compare(results, baseline, args.tolerance)
+
+        for name, seconds in results.items():
+            line = f"{name:32} {seconds * 1e6:12.3f} us"
+            if name in baseline:
+                line += f" {seconds / baseline[name]:8.2f}x"
+            if name in regressions:
+                line += "  REGRESSION"
+            print(line)
+
+        if args.update:
+            if not args.baseline:
+                raise SystemExit("--update needs --baseline")
+            args.baseline.write_text(dump_baseline(results) + "\n")
+            print(f"Wrote baseline to {args.baseline}")
+
+        if regressions:
+            print(f"{len(regressions)} benchmarks slower than the baseline by more than {args.tolerance:.0%}")
+            raise SystemExit(1)
+
+
+def setup_cors(app):
+    return aiohttp_cors.setup(app, defaults={
+       "*": aiohttp_cors.ResourceOptions(
+            allow_credentials=True,
+            expose_headers="*",
+            allow_headers="*"
+        )
+      })
+
+
+def add_frontend_routes(app):
+    static_files = files("kneipenquiz3000.frontend")
+    AssetManifest(static_files._paths[0]).add_routes(app)
+
+
+def create_app(args, owns_game=None, frontend=True):
+    """Create the game server app
+
+    :param owns_game: Called with a game key, decides whether this process
+        hosts the game (used by sharded workers)
+    :param frontend: Whether the frontend may be served by this app
+    """
+    limiter.max_inflight = args.max_inflight
+    signer.configure(args.token_secret)
+    app = web.Application(middlewares=[metrics.middleware, limiter.middleware])
+    app.cleanup_ctx.append(metrics.measure_loop_lag)
+    app.cleanup_ctx.append(expire_emotions)
+    app.cleanup_ctx.append(wheel.context)
+    if args.watchdog:
+        app.cleanup_ctx.append(Watchdog(args.watchdog).context)
+
+    # Add cors setting for dev mode
+    if args.devcors:
+        cors = setup_cors(app)
+
+    # Initialize routes
+    app.add_routes(routes)
+
+    # Initialize frontend routes
+    if frontend and args.frontend:
+        add_frontend_routes(app)
+
+    if args.devcors:
+        for route in list(app.router.routes()):
+            cors.add(route)
+
+    journals = None
+    if args.journal_dir:
+        journals = app["journals"] = JournalManager(args.journal_dir)
+        app.cleanup_ctx.append(journals.context)
+
+        if args.resume:
+            for game in journals.resume(owns_game):
+                Game.add_game(game)
+                deadlines.schedule(game)
+
+    if args.quiz_dir:
+        # Games are created on demand from the quiz directory
+        app["quiz_library"] = QuizLibrary(args.quiz_dir)
+        app["admin_password"] = args.admin_password
+        app.cleanup_ctx.append(game_evictor(args.idle_ttl, args.results_dir))
+    elif (owns_game is None or owns_game(args.name)) and args.name not in Game.games:
         # Add game
         quiz = Quiz.from_path(args.quiz)
-        password = args.password if args.password else secrets.token_urlsafe(10)
-        game = Game(quiz, key=args.name, gamemaster_password=password)
+        if errors := quiz.validate():
+            raise InvalidQuizException("\n".join(errors))
+        game = Game(quiz, key=args.name, gamemaster_password=args.password)
         Game.add_game(game)
 
-        # Run app
-        web.run_app(app, host=args.host, port=args.port)
+        if journals is not None:
+            journals.attach(game, args.quiz.resolve())
+
+    return app
@@ -0,0 +1,117 @@
+"""
+Compiled quiz files.
+
+`kneipenquiz3000 compile` validates a quiz and stores it as a marshal dump
+next to the source (`<quiz>.kq3c`). `Quiz.from_path` prefers this file as
+long as it matches the source, which is checked by size and mtime and,
+if those changed, by the sha256 of the source. Only valid quizzes are
+compiled, so a compiled quiz is not validated again and its questions are
+only built once they are accessed.
+"""
+import os
+import json
+import marshal
+import hashlib
+from pathlib import Path
+from .states import Quiz, QuestionBlock, Question, Answer
+
+
+MAGIC = b"KQ3C"
+FORMAT_VERSION = (2, marshal.version)
+SUFFIX = ".kq3c"
+
+
+def compiled_path(path):
+    path = Path(path)
+    return path.with_name(path.name + SUFFIX)
+
+
+def _digest(path):
+    with open(path, "rb") as f:
+        return hashlib.sha256(f.read()).digest()
+
+
+def _dump_question(question):
+    return (
+        question.title, question.renderer,
+        question.guess_min, question.guess_max, question.guess_start, question.guess_target,
+        tuple((answer.correct, answer.kwargs) for answer in question.answers), question.time,
+    )
+
+
+def _dump_quiz(quiz):
+    return (quiz.name, quiz.title, tuple(
+        (block.title, tuple(_dump_question(question) for question in block.questions))
+        for block in quiz.blocks
+    ))
+
+
+def _load_question(data):
+    title, renderer, guess_min, guess_max, guess_start, guess_target, answers, time = data
+    return Question(
+        title, renderer,
+        [Answer(correct, **kwargs) for correct, kwargs in answers],
+        guess_min=guess_min, guess_max=guess_max, guess_start=guess_start,
+        guess_target=guess_target, time=time,
+    )
+
+
+def _load_quiz(data):
+    name, title, blocks = data
+    quiz = Quiz(name, title, [
+        QuestionBlock(block_title, questions, decode=_load_question)
+        for block_title, questions in blocks
+    ])
+    # Only quizzes without errors are compiled, validating again would
+    # decode all questions
+    quiz._errors = []
+    return quiz
+
+
+def load_compiled(path):
+    """Load the compiled version of a quiz, `None` if missing or outdated"""
+    try:
+        with open(compiled_path(path), "rb") as f:
+            raw = f.read()
+    except OSError:
+        return None
+
+    if not raw.startswith(MAGIC):
+        return None
+
+    try:
+        version, size, mtime, digest, data = marshal.loads(raw[len(MAGIC):])
+    except (ValueError, EOFError, TypeError):
+        return None
+
+    if version != FORMAT_VERSION:
+        return None
+
+    stat = os.stat(path)
+    if (stat.st_size, stat.st_mtime_ns) != (size, mtime) and _digest(path) != digest:
+        return None
+
+    quiz = _load_quiz(data)
+    # The hash of the source, the quiz is the same
+    quiz._digest = digest.hex()[:20]
+    return quiz
+
+
+def compile_quiz(path, write=True):
+    """Parse and validate a quiz, write the compiled version if it's valid
+
+    Returns the quiz and the list of validation errors.
+    """
+    with open(path) as f:
+        data = json.load(f)
+    if "bank" in data:
+        raise ValueError("Quizzes sampled from a question bank can't be compiled")
+    quiz = Quiz.from_json(data)
+
+    errors = quiz.validate()
+    if write and not errors:
+        stat = os.stat(path)
+        data = (FORMAT_VERSION, stat.st_size, stat.st_mtime_ns, _digest(path), _dump_quiz(quiz))
+        with open(compiled_path(path), "wb") as f:
+            f.write(MAGIC + marshal.dumps(data))
+    return quiz, errors
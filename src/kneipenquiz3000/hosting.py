@@ -0,0 +1,135 @@
+"""
+Hosting of many games in one server.
+
+Quizzes are taken from a directory and only parsed once a game asks for
+them. Games that ended or were idle for too long are removed again after
+their final scores were written to disk.
+"""
+import json
+import time
+import asyncio
+from datetime import datetime
+from pathlib import Path
+from urllib.parse import quote
+from .states import Game, Quiz
+from .bank import BankQuizSpec
+from .cache import view_cache
+from .stream import close_game_stream
+from .timers import deadlines
+from .logs import logger
+
+
+# Seconds an ended game is kept around so the final scores can be shown
+END_GRACE = 300
+
+# Seconds between two checks for games to evict
+EVICT_INTERVAL = 60
+
+
+class QuizLibrary:
+    def __init__(self, directory):
+        self.directory = Path(directory)
+        self._quizzes = {}
+
+    def names(self):
+        return sorted(path.stem for path in self.directory.glob("*.json"))
+
+    def get_path(self, name):
+        path = self.directory / f"{name}.json"
+        if path.parent != self.directory or not path.is_file():
+            raise KeyError(f"Quiz \"{name}\" not found")
+        return path
+
+    def get(self, name):
+        """Return a quiz, parsing the file only if it's new or changed
+
+        Quizzes are immutable, all games of a quiz share the same object,
+        only quizzes drawn from a question bank are sampled for every game.
+        """
+        path = self.get_path(name)
+        mtime = path.stat().st_mtime_ns
+
+        try:
+            quiz_mtime, quiz = self._quizzes[name]
+        except KeyError:
+            quiz_mtime = None
+
+        if quiz_mtime != mtime:
+            quiz = Quiz.from_path(path, sample=False)
+            self._quizzes[name] = (mtime, quiz)
+            logger.debug("Loaded quiz %s from %s", name, path)
+
+        if isinstance(quiz, BankQuizSpec):
+            return quiz.sample()
+        return quiz
+
+
+def persist_results(game, directory):
+    directory = Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+
+    finished = datetime.now()
+    path = directory / f"{quote(str(game.key), safe='')}-{finished:%Y%m%d-%H%M%S}.json"
+    with open(path, "w") as f:
+        json.dump({
+            "key": game.key,
+            "name": game.name,
+            "title": game.title,
+            "finished": finished.isoformat(),
+            "game_state": game.game_state.name,
+            "score_data": game.score_data,
+        }, f, indent=2)
+    return path
+
+
+def is_expired(game, idle_ttl, now=None):
+    idle = (now or time.monotonic()) - game.last_activity
+    if not game.active:
+        return idle > min(idle_ttl, END_GRACE)
+    return idle > idle_ttl
+
+
+def evict_game(game, results_directory=None):
+    if results_directory is not None:
+        path = persist_results(game, results_directory)
+        logger.info("Stored results of game %s in %s", game.key, path)
+    elif game.team_count:
+        # Nothing else keeps the scores
+        ranking = game.leaderboard(0, game.team_count)["entries"]
+        logger.info("Final ranking of game %s: %s", game.key, ", ".join(
+            f"{entry['rank']}. {entry['name']} ({entry['score']})" for entry in ranking
+        ))
+
+    if game.journal is not None:
+        game.journal.close(remove=True)
+
+    Game.remove_game(game)
+    view_cache.discard(game)
+    deadlines.discard(game)
+    close_game_stream(game)
+    logger.info("Evicted game %s", game.key)
+
+
+def evict_expired_games(idle_ttl, results_directory=None):
+    now = time.monotonic()
+    for game in [game for game in Game.get_games() if is_expired(game, idle_ttl, now)]:
+        try:
+            evict_game(game, results_directory)
+        except Exception:
+            # Keep evicting the other games, this one is tried again next time
+            logger.exception("Could not evict game %s", game.key)
+
+
+def game_evictor(idle_ttl, results_directory=None):
+    """Cleanup context periodically evicting expired games"""
+    async def run():
+        while True:
+            await asyncio.sleep(EVICT_INTERVAL)
+            evict_expired_games(idle_ttl, results_directory)
+
+    async def context(app):
+        task = asyncio.ensure_future(run())
+        yield
+        task.cancel()
+
+    return context
@@ -0,0 +1,160 @@
+"""
+Ingestion of the high frequency team input, guesses and emotions.
+
+Values are coalesced: the first one of a team is applied right away,
+later ones within `COALESCE_WINDOW` only replace the pending value, which
+is applied once the window closes (last write wins). Every team has a
+token bucket per action that the applied values take from; a value that
+would open a new window without a token left is turned away with `429`
+and `Retry-After`, a pending one waits for the next token. A guess slider dragged across the
+screen thus changes the game a few times per second instead of with
+every request.
+"""
+import math
+import time
+import asyncio
+from aiohttp import web
+from .states import Game, GameException
+from .metrics import metrics, label_value
+from .logs import logger
+
+
+# Tokens per second and bucket size of each action
+RATES = {
+    "guess": (5, 10),
+    "emotion": (2, 6),
+}
+
+# Seconds within which values of a team are coalesced
+COALESCE_WINDOW = 0.25
+
+# Full buckets are dropped once there are more than this many
+PRUNE_SIZE = 4096
+
+# Seconds between two checks for emotions leaving the window of their game
+EXPIRE_INTERVAL = 1
+
+
+class TokenBuckets:
+    """Token buckets by key, created full on first use"""
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        # key: [tokens, last refill]
+        self.buckets = {}
+
+    def take(self, key, now=None):
+        """Take a token, returns 0 or the seconds until one is available"""
+        now = now if now is not None else time.monotonic()
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            if len(self.buckets) >= PRUNE_SIZE:
+                self.prune(now)
+            bucket = self.buckets[key] = [self.burst, now]
+        else:
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+
+        if bucket[0] < 1:
+            return (1 - bucket[0]) / self.rate
+        bucket[0] -= 1
+        return 0
+
+    def prune(self, now):
+        # A bucket that refilled completely is the same as a new one
+        full = self.burst / self.rate
+        for key in [key for key, (_, stamp) in self.buckets.items() if now - stamp >= full]:
+            del self.buckets[key]
+
+
+class Ingest:
+    def __init__(self, rates=RATES, window=COALESCE_WINDOW):
+        self.window = window
+        self.buckets = {action: TokenBuckets(rate, burst) for action, (rate, burst) in rates.items()}
+        # Windows open per (game, session, action), holding the pending value if any
+        self.pending = {}
+        self.rejected = dict.fromkeys(rates, 0)
+        self.coalesced = dict.fromkeys(rates, 0)
+
+    def submit(self, game, team, action, value, apply):
+        """Apply `apply(value)` for a team, coalesced and rate limited
+
+        Raises `HTTPTooManyRequests` if the team ran out of tokens.
+        """
+        key = (game.key, team.cookie, action)
+        if key in self.pending:
+            # Only replaces the pending value, the token is taken once it's applied
+            if self.pending[key] is not None:
+                self.coalesced[action] += 1
+            self.pending[key] = (game, team, value, apply)
+            return
+
+        wait = self.buckets[action].take(key)
+        if wait:
+            self.rejected[action] += 1
+            raise web.HTTPTooManyRequests(headers={"Retry-After": str(math.ceil(wait))})
+
+        apply(value)
+        self._open(key)
+
+    def _open(self, key, delay=None):
+        if key not in self.pending:
+            self.pending[key] = None
+        asyncio.get_event_loop().call_later(self.window if delay is None else delay, self._close, key)
+
+    def _close(self, key):
+        entry = self.pending.get(key)
+        if entry is not None:
+            wait = self.buckets[key[2]].take(key)
+            if wait:
+                # Out of tokens, the value stays pending until there is one
+                self._open(key, wait)
+                return
+        del self.pending[key]
+        if entry is not None and self._apply(key, entry):
+            self._open(key)
+
+    def _apply(self, key, entry):
+        game, team, value, apply = entry
+        # The team may have left or the game may be gone in the meantime
+        if Game.games.get(game.key) is not game or not game.has_team(team):
+            return False
+        try:
+            apply(value)
+        except GameException as e:
+            logger.debug("Dropped coalesced %s of team %s in game %s: %s", key[2], team.name, game.key, e)
+            return False
+        return True
+
+    def flush(self, game):
+        """Apply the pending values of a game now, before its state moves on"""
+        for key, entry in list(self.pending.items()):
+            if entry is not None and key[0] == game.key:
+                # The window stays open, it's closed by its timer
+                self.pending[key] = None
+                self._apply(key, entry)
+
+    def metric_samples(self):
+        yield "# TYPE quiz_ingest_rejected_total counter"
+        for action, count in self.rejected.items():
+            yield f'quiz_ingest_rejected_total{{action="{label_value(action)}"}} {count}'
+        yield "# TYPE quiz_ingest_coalesced_total counter"
+        for action, count in self.coalesced.items():
+            yield f'quiz_ingest_coalesced_total{{action="{label_value(action)}"}} {count}'
+
+
+async def expire_emotions(app):
+    """Cleanup context updating the emotion counts of all games as time passes"""
+    async def run():
+        while True:
+            await asyncio.sleep(EXPIRE_INTERVAL)
+            for game in Game.get_games():
+                game.expire_emotions()
+
+    task = asyncio.ensure_future(run())
+    yield
+    task.cancel()
+
+
+ingest = Ingest()
+metrics.add_collector(ingest.metric_samples)
@@ -0,0 +1,264 @@
+"""
+Append only journal of game actions for crash recovery.
+
+Every state changing action of a game is buffered as a json line and
+written to `<game>.journal` in batches by a single io thread, followed by
+one fsync per batch. Every `SNAPSHOT_EVERY` actions the full game state is
+written to `<game>.snapshot` and the journal is truncated. Resuming loads
+the snapshot and replays the journal entries that came after it.
+"""
+import os
+import json
+import asyncio
+from pathlib import Path
+from urllib.parse import quote, unquote
+from concurrent.futures import ThreadPoolExecutor
+from .states import Game, Quiz, Team, Gamemaster, GameStates, QuestionStates, ScreenStates
+from .bank import BankQuiz
+from .logs import logger
+
+
+# Seconds between two flushes of the journal buffers
+FLUSH_INTERVAL = 0.5
+
+# Number of journal entries after which a new snapshot is written
+SNAPSHOT_EVERY = 1000
+
+
+def _write_lines(path, lines):
+    with open(path, "a") as f:
+        f.writelines(lines)
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def _write_snapshot(path, journal_path, data):
+    tmp_path = path.with_suffix(".tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(data, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+    # Everything up to here is part of the snapshot
+    with open(journal_path, "w") as f:
+        os.fsync(f.fileno())
+
+
+def _remove(*paths):
+    for path in paths:
+        try:
+            path.unlink()
+        except FileNotFoundError:
+            pass
+
+
+def snapshot_game(game, source):
+    return {
+        "source": source,
+        # The questions drawn for the game if it's sampled from a question bank
+        "records": game.questions.records if isinstance(game.questions, BankQuiz) else None,
+        "key": game.key,
+        "gamemaster_password": game.gamemaster_password,
+        "game_state": game.game_state.name,
+        "question_state": game.question_state.name if game.question_state else None,
+        "screen_state": game.screen_state.name,
+        "current_question_index": game.current_question_index,
+        "deadline": game.deadline,
+        "orders": [[*index, order] for index, order in game.orders.items()],
+        "teams": [
+            {
+                "address": team.address,
+                "name": team.name,
+                "cookie": team.cookie,
+                "active": team.active,
+                "current_answer": team.current_answer,
+                "current_emotion": team.current_emotion,
+                "current_answer_score": team.current_answer_score,
+                "current_score": team.current_score,
+            }
+            for team in game.teams
+        ],
+        "gamemasters": [[gamemaster.address, gamemaster.cookie] for gamemaster in game.gamemasters],
+        "screens": [[screen.address, screen.cookie] for screen in game.screens],
+        "revoked": sorted(game.revoked),
+    }
+
+
+def restore_game(data):
+    if data.get("records") is not None:
+        quiz = Quiz.from_path(data["source"], sample=False).sample(records=data["records"])
+    else:
+        quiz = Quiz.from_path(data["source"])
+    game = Game(quiz, key=data["key"], gamemaster_password=data["gamemaster_password"])
+    for block_index, question_index, order in data["orders"]:
+        game.orders[block_index, question_index] = order
+    game.game_state = GameStates[data["game_state"]]
+    if data["question_state"]:
+        game.question_state = QuestionStates[data["question_state"]]
+    game.screen_state = ScreenStates[data["screen_state"]]
+    if data["current_question_index"] is not None:
+        game.current_question_index = tuple(data["current_question_index"])
+        # Collects the answers restored with the teams
+        game.reset_answers()
+    game.deadline = data.get("deadline")
+
+    for team_data in data["teams"]:
+        team = Team(team_data["address"], team_data["name"], team_data["cookie"])
+        game.join_team(team)
+        for key in ("active", "current_answer", "current_emotion", "current_answer_score", "current_score"):
+            setattr(team, key, team_data[key])
+
+    for address, cookie in data["gamemasters"]:
+        game.join_gamemaster(game.gamemaster_password, Gamemaster(address, cookie))
+    for address, cookie in data["screens"]:
+        game.join_screen(Gamemaster(address, cookie))
+    game.revoked.update(data.get("revoked", ()))
+    return game
+
+
+def replay(game, action, args):
+    """Apply a journal entry to a game"""
+    if action == "join_team":
+        game.join_team(Team(*args))
+    elif action == "leave_team":
+        game.leave_team(game.get_team_by_cookie(args[0]))
+    elif action == "guess":
+        game.guess(game.get_team_by_cookie(args[0]), args[1])
+    elif action == "show_emotion":
+        game.show_emotion(game.get_team_by_cookie(args[0]), args[1])
+    elif action == "join_gamemaster":
+        game.join_gamemaster(game.gamemaster_password, Gamemaster(*args))
+    elif action == "leave_gamemaster":
+        game.leave_gamemaster(game.get_gamemaster_by_cookie(args[0]))
+    elif action == "join_screen":
+        game.join_screen(Gamemaster(*args))
+    elif action == "leave_screen":
+        game.leave_screen(game.get_screen_by_cookie(args[0]))
+    elif action == "ask_next_question":
+        game.ask_next_question(order=args[0])
+    elif action == "show_question":
+        game.show_question(tuple(args[0]))
+    elif action == "set_deadline":
+        game.set_deadline(args[0])
+    elif action == "score_answer":
+        game.score_answer()
+    elif action == "show_answer":
+        game.show_answer(args[0])
+    elif action == "set_screen_state":
+        game.set_screen_state(ScreenStates[args[0]])
+    elif action == "start_game":
+        game.start_game()
+    elif action == "end_game":
+        game.end_game()
+    else:
+        raise ValueError(f"Unknown journal action {action}")
+
+
+class Journal:
+    def __init__(self, manager, game, source, seq=0):
+        self.manager = manager
+        self.game = game
+        self.source = source
+        self.seq = seq
+        self.snapshot_seq = seq
+        self._buffer = []
+
+        name = quote(str(game.key), safe="")
+        self.path = manager.directory / f"{name}.journal"
+        self.snapshot_path = manager.directory / f"{name}.snapshot"
+
+    def record(self, action, *args):
+        self.seq += 1
+        self._buffer.append(json.dumps([self.seq, action, *args]) + "\n")
+
+    def flush(self):
+        """Hand buffered entries to the io thread, snapshot if due"""
+        if self._buffer:
+            lines, self._buffer = self._buffer, []
+            self.manager.submit(_write_lines, self.path, lines)
+
+        if self.seq - self.snapshot_seq >= SNAPSHOT_EVERY:
+            self.snapshot()
+
+    def snapshot(self):
+        data = {"seq": self.seq, **snapshot_game(self.game, self.source)}
+        self.snapshot_seq = self.seq
+        self.manager.submit(_write_snapshot, self.snapshot_path, self.path, data)
+
+    def close(self, remove=False):
+        self.game.journal = None
+        self.manager.journals.pop(self.game.key, None)
+        if remove:
+            self._buffer = []
+            self.manager.submit(_remove, self.path, self.snapshot_path)
+        else:
+            self.flush()
+
+
+class JournalManager:
+    def __init__(self, directory):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.journals = {}
+        # A single thread keeps the writes of all journals in order
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="journal")
+
+    def submit(self, func, *args):
+        return self.executor.submit(func, *args)
+
+    def attach(self, game, source, seq=0):
+        journal = Journal(self, game, str(source), seq=seq)
+        self.journals[game.key] = journal
+        game.journal = journal
+        if seq == 0:
+            journal.snapshot()
+        return journal
+
+    def flush(self):
+        for journal in self.journals.values():
+            journal.flush()
+
+    def resume(self, owns_game=None):
+        """Restore all journaled games from the journal directory"""
+        games = []
+        for snapshot_path in sorted(self.directory.glob("*.snapshot")):
+            key = unquote(snapshot_path.stem)
+            if owns_game is not None and not owns_game(key):
+                continue
+
+            with open(snapshot_path) as f:
+                data = json.load(f)
+            game = restore_game(data)
+            seq = data["seq"]
+
+            journal_path = snapshot_path.with_suffix(".journal")
+            if journal_path.exists():
+                with open(journal_path) as f:
+                    for line in f:
+                        try:
+                            entry_seq, action, *args = json.loads(line)
+                        except ValueError:
+                            # Torn write of the last entry
+                            break
+                        if entry_seq > seq:
+                            replay(game, action, args)
+                            seq = entry_seq
+
+            self.attach(game, data["source"], seq=seq)
+            games.append(game)
+            logger.info("Resumed game %s at journal entry %s", game.key, seq)
+        return games
+
+    async def context(self, app):
+        """Cleanup context flushing the journals periodically"""
+        async def run():
+            while True:
+                await asyncio.sleep(FLUSH_INTERVAL)
+                self.flush()
+
+        task = asyncio.ensure_future(run())
+        yield
+        task.cancel()
+        self.flush()
+        self.executor.shutdown(wait=True)
@@ -0,0 +1,94 @@
+"""
+Keeping the server responsive under load.
+
+Polling responses recommend clients when to poll next (`X-Poll-Interval`
+in milliseconds), depending on the phase of the game and the current load.
+The `ConcurrencyLimiter` turns requests away with `503` and `Retry-After`
+once too many are in flight, so the admitted ones stay fast.
+"""
+from aiohttp import web
+from .states import GameStates, QuestionStates, ScreenStates
+from .metrics import metrics
+
+
+# Recommended poll interval in milliseconds per phase of the game
+POLL_INTERVALS = {
+    "idle": 5000,
+    "ask": 1000,
+    "question": 2000,
+    "end": 10000,
+}
+# At full load the interval is stretched by this factor
+MAX_LOAD_FACTOR = 5
+
+# In flight requests considered full load without a limiter
+DEFAULT_CAPACITY = 256
+
+RETRY_AFTER = 2
+
+
+def poll_phase(game):
+    # Decided by the game and question state, the screen state is set by the
+    # gamemaster and only tells a finished game apart from a running question
+    if game.game_state == GameStates.END:
+        return "end"
+    if game.game_state == GameStates.INIT or game.question_state is None:
+        return "idle"
+    if game.question_state == QuestionStates.ASK:
+        return "ask"
+    if game.screen_state == ScreenStates.FINAL:
+        return "idle"
+    return "question"
+
+
+def poll_interval(game, load=0):
+    """Milliseconds until a client should poll `game` again, `load` between 0 and 1"""
+    return int(POLL_INTERVALS[poll_phase(game)] * (1 + (MAX_LOAD_FACTOR - 1) * min(load, 1)))
+
+
+def _is_exempt(request):
+    # Event streams cost nothing while they wait, metrics should still be
+    # scraped when overloaded. Long-polls give their slot back once they
+    # are parked, see `release`.
+    return request.path.endswith("/stream") or request.path == "/metrics"
+
+
+class ConcurrencyLimiter:
+    def __init__(self, max_inflight=None):
+        self.max_inflight = max_inflight
+        self.in_flight = 0
+        self.rejected = 0
+
+    @property
+    def load(self):
+        return self.in_flight / (self.max_inflight or DEFAULT_CAPACITY)
+
+    @web.middleware
+    async def middleware(self, request, handler):
+        if _is_exempt(request):
+            return await handler(request)
+
+        if self.max_inflight is not None and self.in_flight >= self.max_inflight:
+            self.rejected += 1
+            raise web.HTTPServiceUnavailable(headers={"Retry-After": str(RETRY_AFTER)})
+
+        self.in_flight += 1
+        request["in_flight"] = True
+        try:
+            return await handler(request)
+        finally:
+            self.release(request)
+
+    def release(self, request):
+        """Stop counting a request as in flight, e.g. while it's parked"""
+        if request.get("in_flight"):
+            request["in_flight"] = False
+            self.in_flight -= 1
+
+    def metric_samples(self):
+        yield "# TYPE quiz_requests_rejected_total counter"
+        yield f"quiz_requests_rejected_total {self.rejected}"
+
+
+limiter = ConcurrencyLimiter()
+metrics.add_collector(limiter.metric_samples)
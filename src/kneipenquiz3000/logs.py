@@ -1,3 +1,100 @@
+"""
+Logging of the quiz.
+
+`setup_logging` puts the configured handlers behind a queue, so request
+handlers only enqueue records and formatting and writing happens on a
+background thread. High frequency events are logged to child loggers of
+`logger` (`quiz.guess`, `quiz.emotion`, `quiz.access`), which can be
+sampled and rate limited per category.
+"""
+import time
+import queue
+import atexit
 import logging
+from logging.handlers import QueueHandler, QueueListener
 
 logger = logging.getLogger("quiz")
+
+guess_logger = logger.getChild("guess")
+emotion_logger = logger.getChild("emotion")
+access_logger = logger.getChild("access")
+
+CATEGORIES = {
+    "guess": guess_logger,
+    "emotion": emotion_logger,
+    "access": access_logger,
+}
+
+# Records per second of the high frequency categories unless configured
+DEFAULT_RATES = {"guess": 20, "emotion": 20, "access": 20}
+
+
+class SamplingFilter(logging.Filter):
+    """Let every `every`th record through, at most `rate` per second"""
+    def __init__(self, every=1, rate=None):
+        super().__init__()
+        self.every = every
+        self.rate = rate
+        self.count = 0
+        self.window = 0
+        self.passed = 0
+        self.suppressed = 0
+
+    def filter(self, record):
+        self.count += 1
+        if self.count % self.every:
+            self.suppressed += 1
+            return False
+
+        if self.rate is not None:
+            window = int(time.monotonic())
+            if window != self.window:
+                self.window = window
+                self.passed = 0
+            if self.passed >= self.rate:
+                self.suppressed += 1
+                return False
+            self.passed += 1
+        return True
+
+
+class _QueueHandler(QueueHandler):
+    def prepare(self, record):
+        # Formatting is left to the listener thread, the stock handler
+        # would format the message right here on the event loop
+        return record
+
+
+_listener = None
+
+
+def setup_logging(level=None, samples=None, rates=None):
+    """Move the root handlers behind a queue and configure the sampling
+
+    :param level: Level name of the quiz logger
+    :param samples: Map of category to `every`, only every `every`th record is kept
+    :param rates: Map of category to the maximum records per second
+    """
+    global _listener
+
+    root = logging.getLogger()
+    if _listener is None:
+        handlers = root.handlers[:] or [logging.StreamHandler()]
+        records = queue.SimpleQueue()
+        for handler in handlers:
+            root.removeHandler(handler)
+        root.addHandler(_QueueHandler(records))
+
+        _listener = QueueListener(records, *handlers, respect_handler_level=True)
+        _listener.start()
+        atexit.register(_listener.stop)
+
+    if level:
+        logger.setLevel(level.upper())
+
+    rates = {**DEFAULT_RATES, **(rates or {})}
+    samples = samples or {}
+    for category, category_logger in CATEGORIES.items():
+        for existing in category_logger.filters[:]:
+            category_logger.removeFilter(existing)
+        category_logger.addFilter(SamplingFilter(samples.get(category, 1), rates.get(category)))
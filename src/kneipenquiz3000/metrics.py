@@ -0,0 +1,153 @@
+"""
+Prometheus style metrics.
+
+Histograms have fixed buckets and only count, so recording a request costs
+a dict lookup and a few integer increments. Everything else (the per game
+gauges, the view cache) is read when `/metrics` is scraped.
+"""
+import time
+import asyncio
+from bisect import bisect_left
+from aiohttp import web
+
+
+# Upper bounds in seconds
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+FAST_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.1)
+
+# Seconds between two event loop lag probes
+LAG_INTERVAL = 0.5
+
+
+def label_value(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        # The last slot counts the values above all buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def samples(self, name, labels=""):
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            yield f'{name}_bucket{{{labels}le="{bound}"}} {cumulative}'
+        yield f'{name}_bucket{{{labels}le="+Inf"}} {self.count}'
+        labels = f"{{{labels.rstrip(',')}}}" if labels else ""
+        yield f"{name}_sum{labels} {self.sum}"
+        yield f"{name}_count{labels} {self.count}"
+
+
+class RouteMetrics:
+    def __init__(self):
+        self.latency = Histogram()
+        self.statuses = {}
+        self.bytes_sent = 0
+
+
+class Metrics:
+    def __init__(self):
+        self.routes = {}
+        self.serialization = Histogram(FAST_BUCKETS)
+        self.scoring = Histogram(FAST_BUCKETS)
+        self.loop_lag = Histogram(LATENCY_BUCKETS)
+        self.polls = {}
+        self.in_flight = 0
+        # Callables returning more samples on scrape, see `add_collector`
+        self.collectors = []
+
+    def route(self, method, resource):
+        key = (method, resource)
+        route = self.routes.get(key)
+        if route is None:
+            route = self.routes[key] = RouteMetrics()
+        return route
+
+    def poll(self, role):
+        self.polls[role] = self.polls.get(role, 0) + 1
+
+    def add_collector(self, collector):
+        self.collectors.append(collector)
+
+    @web.middleware
+    async def middleware(self, request, handler):
+        start = time.perf_counter()
+        status = 500
+        body_length = 0
+        self.in_flight += 1
+        try:
+            response = await handler(request)
+            status = response.status
+            body_length = response.content_length or 0
+            return response
+        except web.HTTPException as e:
+            status = e.status
+            raise
+        finally:
+            self.in_flight -= 1
+            resource = request.match_info.route.resource
+            route = self.route(request.method, resource.canonical if resource is not None else "unmatched")
+            route.latency.observe(time.perf_counter() - start)
+            route.statuses[status] = route.statuses.get(status, 0) + 1
+            route.bytes_sent += body_length
+
+    async def measure_loop_lag(self, app):
+        """Cleanup context measuring how late the event loop wakes up a sleeper"""
+        async def probe():
+            loop = asyncio.get_running_loop()
+            while True:
+                start = loop.time()
+                await asyncio.sleep(LAG_INTERVAL)
+                self.loop_lag.observe(max(loop.time() - start - LAG_INTERVAL, 0))
+
+        task = asyncio.ensure_future(probe())
+        yield
+        task.cancel()
+
+    def render(self):
+        lines = [
+            "# TYPE quiz_http_request_duration_seconds histogram",
+        ]
+        for (method, path), route in self.routes.items():
+            lines.extend(route.latency.samples(
+                "quiz_http_request_duration_seconds", f'method="{method}",route="{path}",'
+            ))
+
+        lines.append("# TYPE quiz_http_requests_total counter")
+        for (method, path), route in self.routes.items():
+            for status, count in route.statuses.items():
+                lines.append(f'quiz_http_requests_total{{method="{method}",route="{path}",status="{status}"}} {count}')
+
+        lines.append("# TYPE quiz_http_response_bytes_total counter")
+        for (method, path), route in self.routes.items():
+            lines.append(f'quiz_http_response_bytes_total{{method="{method}",route="{path}"}} {route.bytes_sent}')
+
+        lines.append("# TYPE quiz_http_requests_in_flight gauge")
+        lines.append(f"quiz_http_requests_in_flight {self.in_flight}")
+
+        lines.append("# TYPE quiz_polls_total counter")
+        for role, count in self.polls.items():
+            lines.append(f'quiz_polls_total{{role="{role}"}} {count}')
+
+        lines.append("# TYPE quiz_serialization_duration_seconds histogram")
+        lines.extend(self.serialization.samples("quiz_serialization_duration_seconds"))
+        lines.append("# TYPE quiz_scoring_duration_seconds histogram")
+        lines.extend(self.scoring.samples("quiz_scoring_duration_seconds"))
+        lines.append("# TYPE quiz_event_loop_lag_seconds histogram")
+        lines.extend(self.loop_lag.samples("quiz_event_loop_lag_seconds"))
+
+        for collector in self.collectors:
+            lines.extend(collector())
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
@@ -0,0 +1,121 @@
+"""
+Microbenchmarks of the hot paths in `states`.
+
+Each benchmark reports the best time per call over several repeats. The
+results can be stored as a baseline and later runs compared against it,
+failing if a benchmark got slower than the baseline by more than the
+tolerance.
+"""
+import json
+import random
+import timeit
+from .states import Game, Quiz, QuestionBlock, Question, Answer, Team
+from .views import encode
+
+
+TEAM_COUNTS = (10, 1000, 10000)
+REPEAT = 5
+
+
+def make_quiz(blocks=200, questions=25):
+    """A synthetic quiz alternating base and guess questions"""
+    def question(index):
+        if index % 2:
+            return Question(f"Guess {index}", "guess", [Answer(text=str(index))],
+                guess_min=0, guess_max=10000, guess_start=0)
+        return Question(f"Question {index}", "base", [
+            Answer(text=f"Answer {answer}", correct=answer == 1) for answer in range(4)
+        ])
+
+    return Quiz("Benchmark", "Benchmark", [
+        QuestionBlock(f"Block {block}", [question(index) for index in range(questions)])
+        for block in range(blocks)
+    ])
+
+
+def make_game(teams, renderer="base"):
+    rng = random.Random(teams)
+    game = Game(make_quiz(blocks=1, questions=2), key="bench", gamemaster_password="bench")
+    for index in range(teams):
+        game.join_team(Team("127.0.0.1", f"Team {index}", f"cookie-{index}"))
+
+    game.start_game()
+    game.ask_next_question()
+    if renderer == "guess":
+        game.ask_next_question()
+
+    for team in game.teams:
+        if renderer == "guess":
+            game.guess(team, str(rng.randint(0, 10000)))
+        else:
+            game.guess(team, rng.randrange(4))
+    return game
+
+
+def benchmarks():
+    """Yield name and a function setting up a benchmark, returning the callable to time"""
+    for teams in TEAM_COUNTS:
+        for renderer in ("base", "guess"):
+            def setup(teams=teams, renderer=renderer):
+                game = make_game(teams, renderer)
+                return lambda: game.scorer.score(game.current_question, game.team_store, game.current_order)
+            yield f"score_{renderer}_{teams}", setup
+
+    def gamemaster_data():
+        game = make_game(1000)
+        return lambda: encode(game.gamemaster_data)
+    yield "gamemaster_data_1000", gamemaster_data
+
+    def question_data():
+        game = make_game(1000)
+        return lambda: encode(game.question_data)
+    yield "question_data_1000", question_data
+
+    def next_index():
+        quiz = make_quiz()
+        index = (len(quiz.blocks) // 2, 24)
+        return lambda: quiz.get_next_index(index)
+    yield "quiz_get_next_index_5000", next_index
+
+    def quiz_len():
+        quiz = make_quiz()
+        return lambda: len(quiz)
+    yield "quiz_len_5000", quiz_len
+
+    def team_by_cookie():
+        game = make_game(10000)
+        return lambda: game.get_team_by_cookie("cookie-5000")
+    yield "get_team_by_cookie_10000", team_by_cookie
+
+
+def measure(func, repeat=REPEAT):
+    timer = timeit.Timer(func)
+    number, _ = timer.autorange()
+    return min(timer.repeat(repeat=repeat, number=number)) / number
+
+
+def run_microbench(selected=None):
+    results = {}
+    for name, setup in benchmarks():
+        if selected and not any(pattern in name for pattern in selected):
+            continue
+        results[name] = measure(setup())
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """Return the benchmarks slower than their baseline by more than `tolerance`"""
+    regressions = {}
+    for name, seconds in results.items():
+        if name in baseline and seconds > baseline[name] * (1 + tolerance):
+            regressions[name] = seconds / baseline[name]
+    return regressions
+
+
+def load_baseline(path):
+    with open(path) as f:
+        return json.load(f)["results"]
+
+
+def dump_baseline(results):
+    return json.dumps({"results": results}, indent=2, sort_keys=True)
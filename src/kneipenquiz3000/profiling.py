@@ -0,0 +1,155 @@
+"""
+Looking into the running event loop.
+
+`profile_loop` samples the stack of the loop thread from another thread
+for a while and returns the samples in the collapsed stack format that
+flamegraph tools (`flamegraph.pl`, speedscope) read. `cprofile_loop`
+runs cProfile on the loop thread instead, which is exact but slows the
+loop down while it runs.
+
+The `Watchdog` logs the stack of the loop thread whenever the loop doesn't
+get around to its heartbeat for longer than a threshold, i.e. a handler
+blocks it.
+"""
+import io
+import sys
+import time
+import pstats
+import cProfile
+import asyncio
+import threading
+import traceback
+from .logs import logger
+
+
+MAX_DURATION = 60
+DEFAULT_INTERVAL = 0.005
+
+
+class ProfileRunningException(Exception):
+    pass
+
+
+_profiling = threading.Lock()
+
+
+def _frame_name(frame):
+    code = frame.f_code
+    return f"{code.co_name} ({code.co_filename.rsplit('/', 1)[-1]}:{frame.f_lineno})"
+
+
+def collapse(frame):
+    """The stack of a frame as `outermost;...;innermost`"""
+    names = []
+    while frame is not None:
+        names.append(_frame_name(frame))
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+def _sample(thread_id, duration, interval):
+    counts = {}
+    deadline = time.monotonic() + duration
+    while time.monotonic() < deadline:
+        frame = sys._current_frames().get(thread_id)
+        if frame is not None:
+            stack = collapse(frame)
+            counts[stack] = counts.get(stack, 0) + 1
+        # Don't keep the loop's frames alive between samples
+        del frame
+        time.sleep(interval)
+    return counts
+
+
+async def profile_loop(duration, interval=DEFAULT_INTERVAL):
+    """Sample the stack of the thread running this loop for `duration` seconds
+
+    Only one profile runs at a time, raises `ProfileRunningException` otherwise.
+    """
+    if not _profiling.acquire(blocking=False):
+        raise ProfileRunningException("A profile is already running")
+
+    try:
+        thread_id = threading.get_ident()
+        loop = asyncio.get_running_loop()
+        # A thread of its own, so long profiles don't occupy the default executor
+        future = loop.create_future()
+
+        def run():
+            try:
+                result = _sample(thread_id, duration, interval)
+            except Exception as e:
+                loop.call_soon_threadsafe(future.set_exception, e)
+            else:
+                loop.call_soon_threadsafe(future.set_result, result)
+
+        threading.Thread(target=run, name="profile", daemon=True).start()
+        counts = await future
+    finally:
+        _profiling.release()
+
+    return "".join(
+        f"{stack} {count}\n"
+        for stack, count in sorted(counts.items(), key=lambda item: -item[1])
+    )
+
+
+async def cprofile_loop(duration):
+    """Profile everything the loop runs for `duration` seconds, return the stats as text"""
+    if not _profiling.acquire(blocking=False):
+        raise ProfileRunningException("A profile is already running")
+
+    try:
+        profile = cProfile.Profile()
+        profile.enable()
+        try:
+            await asyncio.sleep(duration)
+        finally:
+            profile.disable()
+    finally:
+        _profiling.release()
+
+    output = io.StringIO()
+    pstats.Stats(profile, stream=output).sort_stats("cumulative").print_stats(50)
+    return output.getvalue()
+
+
+class Watchdog:
+    def __init__(self, threshold):
+        self.threshold = threshold
+        self.heartbeat = time.monotonic()
+        self.thread_id = None
+        self.running = False
+
+    async def beat(self):
+        while True:
+            self.heartbeat = time.monotonic()
+            await asyncio.sleep(self.threshold / 4)
+
+    def watch(self):
+        reported = None
+        while self.running:
+            time.sleep(self.threshold / 4)
+            heartbeat = self.heartbeat
+            blocked = time.monotonic() - heartbeat
+            # Report every stall once
+            if blocked < self.threshold or reported == heartbeat:
+                continue
+            reported = heartbeat
+
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            stack = "".join(traceback.format_stack(frame))
+            del frame
+            logger.warning("Event loop blocked for over %.3fs, currently at:\n%s", blocked, stack)
+
+    async def context(self, app):
+        self.thread_id = threading.get_ident()
+        self.running = True
+        task = asyncio.ensure_future(self.beat())
+        thread = threading.Thread(target=self.watch, name="watchdog", daemon=True)
+        thread.start()
+        yield
+        self.running = False
+        task.cancel()
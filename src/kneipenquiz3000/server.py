@@ -1,12 +1,21 @@
-import json
-import base64
+import math
+import asyncio
 import secrets
-import re
+import time
+import zlib
 from aiohttp import web
-from enum import Enum
-from .states import Game, ScreenStates, Team, Gamemaster, QuestionStates, TeamAlreadyExistsException, NoMoreQuestionsException
-from .logs import logger
+from .states import Game, ScreenStates, Team, Gamemaster, TeamAlreadyExistsException, NoMoreQuestionsException, GameAlreadyExistsException, InvalidQuizException, QuestionNotAskedException, InvalidGuessException
+from .logs import logger, guess_logger, emotion_logger, access_logger
 from .exceptions import WrongPasswordException
+from .views import props, dump, projection
+from .cache import view_cache, gamemaster_view, GZIP_MIN_SIZE
+from .stream import Subscriber, get_game_stream
+from .metrics import metrics, label_value
+from .load import limiter, poll_interval
+from .ingest import ingest
+from .timers import deadlines
+from .tokens import signer, new_id
+from .profiling import profile_loop, cprofile_loop, ProfileRunningException, MAX_DURATION
 
 
 """
@@ -20,27 +29,107 @@ There are basically three types of clients (in game phase).
 For each of these steps different data is required.
 """
 
-_re_authorization = re.compile(r"^Bearer (?P<token>[a-zA-Z0-9=+/]+)$")
+# Distinguishes etags of this process from those of a previous (restarted) one
+_etag_prefix = secrets.token_hex(4)
+
+# Upper bound in seconds for long-polling requests with `?wait=`
+MAX_WAIT = 30
+
+# Entries per leaderboard page
+MAX_PAGE = 100
+
+# Seconds after which an idle event stream gets a keepalive comment
+STREAM_KEEPALIVE = 15
 
 routes = web.RouteTableDef()
 
 
-def props(item, *keys):
-    return {key: getattr(item, key) for key in keys}
+def json_response(data, **kwargs):
+    start = time.perf_counter()
+    text = dump(data)
+    metrics.serialization.observe(time.perf_counter() - start)
+    return web.json_response(text=text, **kwargs)
 
 
-def _dump_default(arg):
-    if isinstance(arg, Enum):
-        return arg.name
-    return str(arg)
+def game_etag(game, request=None):
+    """The etag of the game state, distinct per query (projection, page)"""
+    variant = ""
+    if request is not None:
+        query = sorted((key, value) for key, value in request.query.items() if key != "wait")
+        if query:
+            variant = "-" + format(zlib.crc32(repr(query).encode("utf8")), "x")
+    return f'"{_etag_prefix}-{game.version}{variant}"'
 
 
-def _dump_with_enum(data):
-    return json.dumps(data, default=_dump_default)
+def _matches_etag(request, etag):
+    header = request.headers.get("If-None-Match")
+    if header is None:
+        return False
+    tags = [tag.strip() for tag in header.split(",")]
+    return "*" in tags or etag in tags or f"W/{etag}" in tags
 
 
-def json_response(data, **kwargs):
-    return web.json_response(data, **kwargs, dumps=_dump_with_enum)
+async def check_not_modified(request, game):
+    """Raise `304 Not Modified` if the client already has the current state
+
+    If the request carries `?wait=<seconds>` it is parked until the game
+    changes or the timeout passes (long-polling).
+    """
+    if not _matches_etag(request, game_etag(game, request)):
+        return
+
+    try:
+        wait = min(float(request.query.get("wait", 0)), MAX_WAIT)
+    except ValueError:
+        raise web.HTTPBadRequest()
+
+    if wait > 0:
+        # Parked long-polls don't count against the in flight limit
+        limiter.release(request)
+        if await game.wait_for_change(game.version, wait):
+            return
+    raise web.HTTPNotModified(headers={
+        "ETag": game_etag(game, request),
+        "X-Poll-Interval": str(poll_interval(game, limiter.load)),
+    })
+
+
+def accepts_gzip(request, body):
+    return len(body) >= GZIP_MIN_SIZE and "gzip" in request.headers.get("Accept-Encoding", "")
+
+
+def view_response(request, game, role, build, team=None):
+    """Respond with a cached role view, gzipped if the client accepts it"""
+    metrics.poll(role.partition("?")[0])
+    entry = view_cache.get(game, role, build)
+    gzip = accepts_gzip(request, entry.body)
+
+    if team is None:
+        body = entry.gzipped if gzip else entry.body
+    else:
+        body = entry.team_gzipped(team) if gzip else entry.team_body(team)
+
+    response = web.Response(body=body, content_type="application/json")
+    if gzip:
+        response.headers["Content-Encoding"] = "gzip"
+    response.headers["Vary"] = "Accept-Encoding"
+    response.headers["ETag"] = game_etag(game, request)
+    # Team and gamemaster views belong to the session of the cookie, not for shared caches
+    public = team is None and role.partition("?")[0] != "gamemaster"
+    response.headers["Cache-Control"] = "no-cache" if public else "private, no-cache"
+    response.headers["X-Poll-Interval"] = str(poll_interval(game, limiter.load))
+    return response
+
+
+def requested_view(request, role):
+    """The view selected with `?fields=a,b` or `?view=slim`, see `projection`"""
+    fields = request.query.get("fields")
+    if fields is not None:
+        fields = [field for field in fields.split(",") if field]
+    try:
+        return projection(role, fields, slim=request.query.get("view") == "slim")
+    except ValueError as e:
+        raise web.HTTPBadRequest(text=str(e))
 
 
 @routes.get("/api/")
@@ -53,21 +142,93 @@ async def root(request):
             for game in Game.get_games()
         ],
     }
-    logger.debug("Access root from %s", request.remote)
+    access_logger.debug("Access root from %s", request.remote)
     return json_response(response)
 
 
+@routes.get("/api/quizzes")
+async def list_quizzes(request):
+    library = get_quiz_library(request)
+    return json_response({"quizzes": library.names()})
+
+
+@routes.put("/api/create_game")
+async def create_game(request):
+    library = get_quiz_library(request)
+    data = await request.json()
+
+    password = str(data.get("password", "")).encode("utf8")
+    if not secrets.compare_digest(password, request.app["admin_password"].encode("utf8")):
+        raise web.HTTPUnauthorized()
+
+    try:
+        quiz = library.get(data["quiz"])
+    except KeyError:
+        raise web.HTTPNotFound()
+
+    if errors := quiz.validate():
+        return json_response({
+            "errorType": InvalidQuizException.__name__,
+            "error": "\n".join(errors),
+        }, status=422)
+
+    key = data.get("name") or data["quiz"]
+    gamemaster_password = data.get("gamemaster_password") or secrets.token_urlsafe(10)
+    game = Game(quiz, key=key, gamemaster_password=gamemaster_password)
+    try:
+        Game.add_game(game)
+    except GameAlreadyExistsException as e:
+        return json_response({
+            "errorType": type(e).__name__,
+            "error": _get_exception_message(e),
+        }, status=422)
+
+    if "journals" in request.app:
+        request.app["journals"].attach(game, library.get_path(data["quiz"]).resolve())
+
+    logger.info("Created game %s with quiz %s from %s", key, data["quiz"], request.remote)
+    return json_response({"key": key, "gamemaster_password": gamemaster_password})
+
+
+def get_quiz_library(request):
+    try:
+        return request.app["quiz_library"]
+    except KeyError:
+        raise web.HTTPNotFound()
+
+
+def game_metric_samples():
+    games = Game.get_games()
+    for name in ("teams", "screens", "gamemasters"):
+        yield f"# TYPE quiz_game_{name} gauge"
+        for game in games:
+            yield f'quiz_game_{name}{{game="{label_value(game.key)}"}} {len(getattr(game, name))}'
+
+
+metrics.add_collector(game_metric_samples)
+
+
+@routes.get("/metrics")
+async def metrics_endpoint(request):
+    return web.Response(text=metrics.render(), headers={
+        "Content-Type": "text/plain; version=0.0.4; charset=utf-8",
+        "Cache-Control": "no-store",
+    })
+
+
+@routes.get("/api/cache_stats")
+async def cache_stats(request):
+    return json_response(view_cache.stats())
+
+
 @routes.get("/api/{game_name}/")
 async def game_root(request):
     game = get_game(request)
-    logger.debug("Access Game:%s", game.name)
+    select = requested_view(request, "game")
+    await check_not_modified(request, game)
+    access_logger.debug("Access Game:%s", game.name)
 
-    return json_response(props(game,
-                "key", "active", "team_count", "game_state", "title", "name",
-                "question_count", "current_question_index", "question_state", "screen_state",
-                "question_data", "guess_data", "emotion_data", "score_data",
-            )
-        )
+    return view_response(request, game, *select(game))
 
 
 def get_game(request):
@@ -77,49 +238,117 @@ def get_game(request):
         raise web.HTTPNotFound()
 
 
-def get_team(request, game):
-    try:
-        return game.get_team_by_cookie(request.cookies["team"])
-    except KeyError:
-        pass
+def get_tokens(request, cookie, query_token=False):
+    """Yield the session tokens a request carries
 
-    try:
-        if mro := _re_authorization.match(request.headers["Authorization"]):
-            return game.get_team_by_cookie(mro.group("token"))
-    except KeyError:
-        pass
+    Tokens are taken from the cookie and the bearer authorization header.
+    Only event streams, for which browsers can't set headers, also accept
+    the `token` query parameter (`query_token`), tokens in urls end up in
+    logs.
+    """
+    if cookie in request.cookies:
+        yield request.cookies[cookie]
+
+    authorization = request.headers.get("Authorization", "")
+    if authorization.startswith("Bearer "):
+        yield authorization[7:]
+
+    if query_token and "token" in request.query:
+        yield request.query["token"]
+
+
+def get_session_id(request, game, role, query_token=False):
+    """The session id of the first valid signed token of `role` for the game"""
+    for token in get_tokens(request, role, query_token):
+        session_id = signer.verify(token, game.key, role)
+        if session_id is not None and session_id not in game.revoked:
+            return session_id
+    return None
+
+
+def get_team(request, game, query_token=False):
+    session_id = get_session_id(request, game, "team", query_token)
+    if session_id is not None:
+        try:
+            return game.get_team_by_cookie(session_id)
+        except KeyError:
+            pass
 
     logger.error("Invalid Team Bearer Token from %s", request.remote)
     raise web.HTTPUnauthorized()
 
-def get_gamemaster(request, game):
-    try:
-        return game.get_gamemaster_by_cookie(request.cookies["gamemaster"])
-    except KeyError:
-        pass
-
-    try:
-        if mro := _re_authorization.match(request.headers["Authorization"]):
-            return game.get_gamemaster_by_cookie(mro.group("token"))
-    except KeyError:
-        pass
+def get_gamemaster(request, game, query_token=False):
+    session_id = get_session_id(request, game, "gamemaster", query_token)
+    if session_id is not None:
+        try:
+            return game.get_gamemaster_by_cookie(session_id)
+        except KeyError:
+            pass
 
     logger.error("Invalid Gamemaster Bearer Token from %s", request.remote)
     raise web.HTTPUnauthorized()
 
 
+@routes.get("/api/{game_name}/stream")
+async def stream(request):
+    """Push the role specific game state as server sent events
+
+    The role is chosen with `?role=screen|team|gamemaster`, teams and
+    gamemasters authenticate just like on the rest endpoints. Screens and
+    teams can project the view with `?fields=` or `?view=slim`.
+    """
+    game = get_game(request)
+    role = request.query.get("role", "screen")
+    team = None
+    session_id = None
+
+    if role == "team":
+        team = get_team(request, game, query_token=True)
+    elif role == "gamemaster":
+        session_id = get_gamemaster(request, game, query_token=True).cookie
+    elif role != "screen":
+        raise web.HTTPBadRequest()
+    select = None if role == "gamemaster" else requested_view(request, "team" if role == "team" else "game")
+
+    response = web.StreamResponse(headers={
+        "Content-Type": "text/event-stream",
+        "Cache-Control": "no-cache",
+    })
+    await response.prepare(request)
+
+    subscriber = Subscriber(role, team, select, session_id)
+    game_stream = get_game_stream(game)
+    game_stream.subscribe(subscriber)
+    logger.debug("Subscribed %s to game %s from %s", role, game.name, request.remote)
+
+    try:
+        while True:
+            try:
+                data = await asyncio.wait_for(subscriber.queue.get(), STREAM_KEEPALIVE)
+            except asyncio.TimeoutError:
+                await response.write(b": keepalive\n\n")
+                continue
+
+            if data is None:
+                break
+            await response.write(b"data: " + data + b"\n\n")
+    except (ConnectionResetError, asyncio.CancelledError):
+        # The client went away
+        logger.debug("Stream of %s to game %s from %s closed by the client", role, game.name, request.remote)
+    finally:
+        game_stream.unsubscribe(subscriber)
+
+    return response
+
+
 # TODO unecessairy
 def get_screen(request, game):
     try:
-        return game.get_team_by_cookie(request.cookies["screen"])
+        return game.get_screen_by_cookie(get_session_id(request, game, "screen"))
     except KeyError:
         raise web.HTTPUnauthorized()
 
 
-def get_secret():
-    return base64.b64encode(secrets.token_bytes(32)).decode("utf8")
-
-
 def _get_exception_message(e):
     try:
         return e.args[0]
@@ -133,10 +362,12 @@ async def join_team(request):
 
     data = await request.json()
     address = request.remote
-    name = data["name"]
-    session_key = get_secret()
+    name = data.get("name") if isinstance(data, dict) else None
+    if not isinstance(name, str) or not name.strip():
+        raise web.HTTPBadRequest(text="The team name must be a non-empty string")
+    session_id = new_id()
 
-    team = Team(address, name, session_key)
+    team = Team(address, name, session_id)
     try:
         game.join_team(team)
     except TeamAlreadyExistsException as e:
@@ -146,25 +377,39 @@ async def join_team(request):
             "error": _get_exception_message(e),
         }, status=422)
 
-    response = json_response(session_key)
-    response.set_cookie("team", session_key)
+    token = signer.sign(game.key, "team", session_id)
+    response = json_response(token)
+    response.set_cookie("team", token)
     logger.debug("Team %s joined game %s from %s", name, game.name, request.remote)
     return response
 
 
+@routes.get("/api/{game_name}/leaderboard")
+async def leaderboard(request):
+    """A page of the leaderboard, `?offset=` and `?limit=` (at most `MAX_PAGE`)"""
+    game = get_game(request)
+    await check_not_modified(request, game)
+
+    try:
+        offset = max(int(request.query.get("offset", 0)), 0)
+        limit = min(max(int(request.query.get("limit", MAX_PAGE)), 0), MAX_PAGE)
+    except ValueError:
+        raise web.HTTPBadRequest()
+
+    response = json_response(game.leaderboard(offset, limit))
+    response.headers["ETag"] = game_etag(game, request)
+    response.headers["Cache-Control"] = "no-cache"
+    return response
+
+
 @routes.get("/api/{game_name}/team")
 async def show_team(request):
     game = get_game(request)
     team = get_team(request, game)
+    select = requested_view(request, "team")
+    await check_not_modified(request, game)
 
-    game_state = props(game,
-            "key", "active", "team_count", "game_state", "title", "name",
-            "question_count", "current_question_index", "question_state", "screen_state",
-            "question_data", "guess_data", "emotion_data", "score_data",
-        )
-    team_state = props(team, "active", "name", "current_answer", "current_emotion")
-
-    return json_response({**game_state, "team_data": team_state})
+    return view_response(request, game, *select(game), team=team)
 
 
 @routes.delete("/api/{game_name}/team")
@@ -182,11 +427,16 @@ async def guess_team(request):
     game = get_game(request)
     team = get_team(request, game)
     answer = await request.json()
+    if game.past_deadline():
+        return json_response({"error": "Time is up"}, status=409)
+    try:
+        game.check_guess(answer)
+    except InvalidGuessException as e:
+        return json_response({"error": str(e)}, status=422)
 
-    if game.question_state == QuestionStates.ASK:
-        team.guess(answer)
+    ingest.submit(game, team, "guess", answer, lambda answer: game.guess(team, answer))
 
-    logger.debug("Team %s of game %s guessed %s", team.name, game.name, answer)
+    guess_logger.debug("Team %s of game %s guessed %s", team.name, game.name, answer)
     return json_response({})
 
 
@@ -195,9 +445,11 @@ async def show_emotion_team(request):
     game = get_game(request)
     team = get_team(request, game)
     emotion = await request.json()
-    team.show_emotion(emotion)
+    if emotion is not None and not isinstance(emotion, str):
+        raise web.HTTPBadRequest()
+    ingest.submit(game, team, "emotion", emotion, lambda emotion: game.show_emotion(team, emotion))
 
-    logger.debug("Team %s of game %s feels %s", team.name, game.name, emotion)
+    emotion_logger.debug("Team %s of game %s feels %s", team.name, game.name, emotion)
     return json_response({})
 
 
@@ -207,16 +459,17 @@ async def join_gamemaster(request):
 
     password = await request.json()
 
-    session_key = get_secret()
+    session_id = new_id()
     address = request.remote
-    gamemaster = Gamemaster(address, session_key)
+    gamemaster = Gamemaster(address, session_id)
     try:
         game.join_gamemaster(password, gamemaster)
     except WrongPasswordException:
         raise web.HTTPUnauthorized()
 
-    response = json_response(session_key)
-    response.set_cookie("gamemaster", session_key)
+    token = signer.sign(game.key, "gamemaster", session_id)
+    response = json_response(token)
+    response.set_cookie("gamemaster", token)
     logger.debug("Gamemaster joined game %s from %s", game.name, request.remote)
     return response
 
@@ -225,8 +478,39 @@ async def join_gamemaster(request):
 async def show_gamemaster(request):
     game = get_game(request)
     gamemaster = get_gamemaster(request, game)
+    await check_not_modified(request, game)
+
+    return view_response(request, game, "gamemaster", gamemaster_view)
 
-    return json_response(game.gamemaster_data)
+
+@routes.get("/api/{game_name}/quiz/{quiz_hash}")
+async def show_quiz(request):
+    """The quiz including the answers, addressed by its content hash
+
+    Gamemaster views only carry the `quiz_hash`, so the quiz is only
+    downloaded again once it changes.
+    """
+    game = get_game(request)
+    get_gamemaster(request, game)
+    digest = game.questions.digest
+
+    if request.match_info["quiz_hash"] != digest:
+        raise web.HTTPNotFound()
+
+    etag = f'"{digest}"'
+    headers = {
+        "ETag": etag,
+        "Cache-Control": "private, max-age=31536000, immutable",
+        "Vary": "Accept-Encoding",
+    }
+    if _matches_etag(request, etag):
+        raise web.HTTPNotModified(headers=headers)
+
+    entry = view_cache.quiz(game)
+    if accepts_gzip(request, entry.body):
+        headers["Content-Encoding"] = "gzip"
+        return web.Response(body=entry.gzipped, content_type="application/json", headers=headers)
+    return web.Response(body=entry.body, content_type="application/json", headers=headers)
 
 
 @routes.delete("/api/{game_name}/gamemaster")
@@ -239,6 +523,36 @@ async def leave_gamemaster(request):
     return json_response({})
 
 
+@routes.get("/api/{game_name}/gamemaster/profile")
+async def profile_gamemaster(request):
+    """Profile the event loop for `?duration=` seconds
+
+    `?mode=sample` (default) returns collapsed stacks for flamegraph tools,
+    `?mode=cprofile` the cProfile statistics.
+    """
+    game = get_game(request)
+    get_gamemaster(request, game)
+
+    try:
+        duration = min(float(request.query.get("duration", 5)), MAX_DURATION)
+    except ValueError:
+        raise web.HTTPBadRequest()
+    mode = request.query.get("mode", "sample")
+
+    logger.warning("Profiling the event loop for %ss (%s) for game %s", duration, mode, game.name)
+    try:
+        if mode == "sample":
+            text = await profile_loop(duration)
+        elif mode == "cprofile":
+            text = await cprofile_loop(duration)
+        else:
+            raise web.HTTPBadRequest()
+    except ProfileRunningException as e:
+        raise web.HTTPConflict(text=str(e))
+
+    return web.Response(text=text, headers={"Cache-Control": "no-store"})
+
+
 @routes.put("/api/{game_name}/gamemaster/{action}")
 async def game_action(request):
     game = get_game(request)
@@ -250,6 +564,9 @@ async def game_action(request):
     except:
         data = None
 
+    # Guesses and emotions still waiting in their coalescing window come first
+    ingest.flush(game)
+
     if action == "end_game":
         game.end_game()
     elif action == "start_game":
@@ -265,6 +582,15 @@ async def game_action(request):
             game.ask_next_question()
         except NoMoreQuestionsException:
             return json_response({"error": "No More questions"}, status=422)
+    elif action == "set_deadline":
+        # Seconds from now, `null` lets the question run until it's scored by hand
+        if data is not None and (not isinstance(data, (int, float)) or isinstance(data, bool)
+                                 or not math.isfinite(data) or data < 0):
+            raise web.HTTPBadRequest()
+        try:
+            game.set_deadline(time.time() + data if data is not None else None)
+        except QuestionNotAskedException as e:
+            return json_response({"error": str(e)}, status=409)
     elif action == "set_screen_state":
         screen_state = ScreenStates[data]
         game.set_screen_state(screen_state)
@@ -272,6 +598,11 @@ async def game_action(request):
         logger.error("Unkown action %s inquired by Gamemaster for Game %s from %s", action, game.name, request.remote)
         raise web.HTTPNotFound()
 
+    # Timed questions get their deadline once they are asked
+    if action in ("ask_next_question", "show_question") and game.current_question.time:
+        game.set_deadline(time.time() + game.current_question.time)
+    deadlines.schedule(game)
+
     logger.debug("Gamemaster took action %s in game %s with params %s", action, game.name, data)
     return json_response({})
 
@@ -280,13 +611,13 @@ async def game_action(request):
 async def join_screen(request):
     game = get_game(request)
 
-    session_key = get_secret()
+    session_id = new_id()
     address = request.remote
-    screen = Gamemaster(address, session_key)
+    screen = Gamemaster(address, session_id)
     game.join_screen(screen)
 
     response = json_response({})
-    response.set_cookie("screen", session_key)
+    response.set_cookie("screen", signer.sign(game.key, "screen", session_id))
     return response
 
 
@@ -0,0 +1,233 @@
+"""
+Sharding of games across worker processes.
+
+With `serve --workers N` the main process only runs a dispatcher. Every
+game is owned by exactly one of N worker processes (chosen by consistent
+hashing on the game key), which listen on their own local port. The
+dispatcher forwards each `/api/{game_name}/...` request to the owning
+worker, so the state of a game keeps a single writer. `/metrics` merges
+the metrics of all workers, labelled by `worker`, `/metrics?worker=N` is
+those of a single worker.
+"""
+import asyncio
+import bisect
+import hashlib
+import multiprocessing
+import aiohttp
+from aiohttp import web
+from .logs import logger
+
+
+# Virtual nodes per worker on the hash ring
+RING_REPLICAS = 64
+
+# Hop by hop headers which must not be forwarded by the proxy
+HOP_HEADERS = {
+    "connection", "keep-alive", "transfer-encoding", "content-length",
+    "upgrade", "host", "te", "trailer", "proxy-authorization", "proxy-authenticate",
+}
+
+
+def _hash(key):
+    return int.from_bytes(hashlib.blake2b(key.encode("utf8"), digest_size=8).digest(), "big")
+
+
+class HashRing:
+    def __init__(self, nodes, replicas=RING_REPLICAS):
+        self.nodes = list(nodes)
+        ring = sorted(
+            (_hash(f"{node}-{replica}"), node)
+            for node in self.nodes
+            for replica in range(replicas)
+        )
+        self._hashes = [point for point, _ in ring]
+        self._nodes = [node for _, node in ring]
+
+    def get(self, key):
+        index = bisect.bisect(self._hashes, _hash(str(key))) % len(self._hashes)
+        return self._nodes[index]
+
+
+def run_worker(args, ring, index, port):
+    from .commands import create_app, setup_serve_logging
+
+    # Workers are spawned without the logging setup of the parent
+    setup_serve_logging(args)
+    app = create_app(args, owns_game=lambda key: ring.get(key) == index, frontend=False)
+    logger.info("Worker %s listening on port %s", index, port)
+    web.run_app(app, host="127.0.0.1", port=port, print=None)
+
+
+def _label_worker(line, index):
+    name, brace, rest = line.partition("{")
+    if brace:
+        return f'{name}{{worker="{index}",{rest}'
+    name, _, value = line.partition(" ")
+    return f'{name}{{worker="{index}"}} {value}'
+
+
+def merge_metrics(texts):
+    """Merge the metrics of the workers, keeping every family together"""
+    families = {}
+    for index, text in enumerate(texts):
+        family = None
+        for line in text.splitlines():
+            if line.startswith("# TYPE ") or line.startswith("# HELP "):
+                family = line.split()[2]
+                header = families.setdefault(family, ([], []))[0]
+                if line not in header:
+                    header.append(line)
+            elif line and not line.startswith("#"):
+                families.setdefault(family, ([], []))[1].append(_label_worker(line, index))
+
+    lines = []
+    for header, samples in families.values():
+        lines.extend(header)
+        lines.extend(samples)
+    return "\n".join(lines) + "\n"
+
+
+class Dispatcher:
+    def __init__(self, ring, ports):
+        self.ring = ring
+        self.ports = ports
+        self.session = None
+
+    def url(self, index, path_qs):
+        return f"http://127.0.0.1:{self.ports[index]}{path_qs}"
+
+    async def session_context(self, app):
+        connector = aiohttp.TCPConnector(limit=0)
+        self.session = aiohttp.ClientSession(connector=connector, auto_decompress=False)
+        yield
+        await self.session.close()
+
+    async def forward(self, request, index, body=None):
+        """Forward a request to a worker and stream the answer back"""
+        if body is None:
+            body = await request.read()
+
+        headers = {
+            key: value for key, value in request.headers.items()
+            if key.lower() not in HOP_HEADERS
+        }
+        headers["X-Forwarded-For"] = request.remote or ""
+
+        try:
+            upstream = await self.session.request(
+                request.method, self.url(index, request.path_qs),
+                headers=headers, data=body, timeout=aiohttp.ClientTimeout(total=None),
+            )
+        except aiohttp.ClientError:
+            logger.error("Worker %s is not reachable", index)
+            raise web.HTTPBadGateway()
+
+        async with upstream:
+            response = web.StreamResponse(status=upstream.status, reason=upstream.reason)
+            for key, value in upstream.headers.items():
+                if key.lower() not in HOP_HEADERS:
+                    response.headers.add(key, value)
+
+            await response.prepare(request)
+            async for chunk in upstream.content.iter_any():
+                await response.write(chunk)
+            await response.write_eof()
+        return response
+
+    async def game(self, request):
+        return await self.forward(request, self.ring.get(request.match_info["game_name"]))
+
+    async def create_game(self, request):
+        body = await request.read()
+        try:
+            data = await request.json()
+            key = data.get("name") or data["quiz"]
+        except (ValueError, KeyError, AttributeError):
+            raise web.HTTPBadRequest()
+        return await self.forward(request, self.ring.get(key), body=body)
+
+    async def other(self, request):
+        # Anything not bound to a game is answered by the first worker
+        return await self.forward(request, 0)
+
+    async def root(self, request):
+        async def fetch(index):
+            try:
+                async with self.session.get(self.url(index, "/api/")) as response:
+                    return (await response.json())["games"]
+            except aiohttp.ClientError:
+                logger.error("Worker %s is not reachable", index)
+                return []
+
+        results = await asyncio.gather(*(fetch(index) for index in range(len(self.ports))))
+        return web.json_response({"games": [game for games in results for game in games]})
+
+    async def metrics(self, request):
+        if "worker" in request.query:
+            try:
+                index = int(request.query["worker"])
+            except ValueError:
+                raise web.HTTPBadRequest()
+            if not 0 <= index < len(self.ports):
+                raise web.HTTPNotFound()
+            return await self.forward(request, index)
+
+        async def fetch(index):
+            try:
+                async with self.session.get(self.url(index, "/metrics")) as response:
+                    return await response.text()
+            except aiohttp.ClientError:
+                logger.error("Worker %s is not reachable", index)
+                return ""
+
+        texts = await asyncio.gather(*(fetch(index) for index in range(len(self.ports))))
+        return web.Response(body=merge_metrics(texts).encode("utf8"), headers={
+            "Content-Type": "text/plain; version=0.0.4; charset=utf-8",
+        })
+
+    def add_routes(self, app):
+        app.router.add_get("/api/", self.root)
+        app.router.add_get("/metrics", self.metrics)
+        app.router.add_put("/api/create_game", self.create_game)
+        for method in ("GET", "PUT", "DELETE"):
+            app.router.add_route(method, "/api/{game_name}/{tail:.*}", self.game)
+            app.router.add_route(method, "/api/{name}", self.other)
+
+
+def run_sharded(args):
+    from .commands import setup_cors, add_frontend_routes
+
+    count = args.workers
+    ring = HashRing(range(count))
+    ports = [args.port + 1 + index for index in range(count)]
+
+    context = multiprocessing.get_context("spawn")
+    workers = [
+        context.Process(target=run_worker, args=(args, ring, index, port), daemon=True)
+        for index, port in enumerate(ports)
+    ]
+    for worker in workers:
+        worker.start()
+
+    dispatcher = Dispatcher(ring, ports)
+    app = web.Application()
+    app.cleanup_ctx.append(dispatcher.session_context)
+
+    if args.devcors:
+        cors = setup_cors(app)
+
+    dispatcher.add_routes(app)
+    if args.frontend:
+        add_frontend_routes(app)
+
+    if args.devcors:
+        for route in list(app.router.routes()):
+            cors.add(route)
+
+    try:
+        web.run_app(app, host=args.host, port=args.port)
+    finally:
+        for worker in workers:
+            worker.terminate()
+        for worker in workers:
+            worker.join()
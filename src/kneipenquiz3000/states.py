@@ -16,11 +16,20 @@ GameState:
 
 """
 import json
+import math
+import hashlib
+import time
+import logging
+import asyncio
 from enum import Enum
+from pathlib import Path
 from pprint import pprint
 from .logs import logger
 from .exceptions import WrongPasswordException
-from random import shuffle
+from random import sample
+import numpy as np
+from .columns import TeamStore, EmotionWindow
+from .metrics import metrics
 
 
 GameStates = Enum("GameState", ("INIT", "PLAY", "END"))
@@ -40,50 +49,130 @@ class TeamAlreadyExistsException(GameException):
     pass
 
 
+class GameAlreadyExistsException(GameException):
+    pass
+
+
+class InvalidQuizException(GameException):
+    pass
+
+
+class QuestionNotAskedException(GameException):
+    pass
+
+
+class InvalidGuessException(GameException):
+    pass
+
+
+RENDERERS = ("base", "guess", "image", "silentVideo")
+
+
+def _hash(data):
+    return hashlib.sha256(data).hexdigest()[:20]
+
+# Teams on the leaderboard in the views
+LEADERBOARD_TOP = 10
+# Teams shown above and below a team
+NEIGHBOURS = 2
+
+
 class Scorer:
     def __init__(self):
         self.default_score = 0
+        self.max_guess_score = 4
 
     def init_score(self, teams):
         for team in teams:
             team.current_score = 0
 
-    def score(self, question, teams):
+    def score(self, question, store, order=None):
+        """Score the answers in `store`, given as index into the answers in `order`"""
+        size = store.size
+        present = store.present[:size]
+
         if question.renderer == "base":
-            for team in teams:
-                if team.current_answer is None:
-                    continue
-                guess = int(team.current_answer)
-                if guess is not None and not isinstance(guess, int):
-                    raise TypeError(f"Answer must be of type (int, None) not {guess}")
-                answer = question.answers[guess]
-                team.current_answer_score = 1 if answer.correct else 0
+            correct = question.correct_mask_in(order)
+            answers = store.answer_index[:size]
+            answered = present & (answers >= 0) & (answers < len(correct))
+            store.answer_score[:size][answered] = correct[answers[answered]]
         elif question.renderer == "guess":
-            max_guess_score = 4
-            answer = float(question.answers[0].kwargs["text"])
-            guesses = [(team, abs(answer - float(team.current_answer))) for team in teams if team.current_answer is not None]
-            guesses = sorted(guesses, key=lambda x:x[1])[:max_guess_score - 1]
-
-            for points, (team, guess) in enumerate(guesses):
-                team.current_answer_score = max_guess_score - points
+            answer = question.guess_target
+            if answer is None:
+                raise InvalidQuizException(f"{question} has no numeric answer to guess")
+            if store.aggregate.target != answer:
+                raise Exception(f"Answers were not collected for {question}")
+
+            # The guesses are kept ordered by distance as they come in
+            closest = store.aggregate.closest(self.max_guess_score - 1)
+            store.answer_score[closest] = self.max_guess_score - np.arange(len(closest))
         else:
             raise Exception(f"Renderer {question.renderer} not implemented")
 
 class Team:
+    """A team, its state is kept in a row of a `TeamStore` once it joined a game"""
     def __init__(self, address, name, cookie):
         self.address = address
         self.name = name
         self.cookie = cookie
-        self.answers = {}
-        self.current_answer = None
-        self.current_emotion = None
-        self.current_answer_score = None
-        self.current_score = None
-        self.active = True
+        self.store = None
+        self.index = None
 
     def __str__(self):
         return f"Team({self.name})"
 
+    @property
+    def active(self):
+        return bool(self.store.active[self.index])
+
+    @active.setter
+    def active(self, active):
+        self.store.active[self.index] = active
+
+    @property
+    def current_answer(self):
+        return self.store.answers[self.index]
+
+    @current_answer.setter
+    def current_answer(self, answer):
+        self.store.set_answer(self.index, answer)
+
+    @property
+    def current_emotion(self):
+        return self.store.emotions[self.index]
+
+    @current_emotion.setter
+    def current_emotion(self, emotion):
+        self.store.emotions[self.index] = emotion
+
+    @property
+    def current_answer_score(self):
+        score = self.store.answer_score[self.index]
+        return None if np.isnan(score) else int(score)
+
+    @current_answer_score.setter
+    def current_answer_score(self, score):
+        self.store.answer_score[self.index] = np.nan if score is None else score
+
+    @property
+    def current_score(self):
+        return int(self.store.score[self.index])
+
+    @current_score.setter
+    def current_score(self, score):
+        self.store.set_score(self.index, score or 0)
+
+    @property
+    def rank(self):
+        return self.store.leaderboard.rank(self.store.score[self.index])
+
+    @property
+    def neighbours(self):
+        """Leaderboard entries right above and below the team, including itself"""
+        leaderboard = self.store.leaderboard
+        position = leaderboard.position(self.index, self.store.score[self.index])
+        return self.store.ranking(leaderboard.rows(position - NEIGHBOURS, position + NEIGHBOURS + 1))
+
     def guess(self, answer):
         self.current_answer = answer
 
@@ -94,7 +183,7 @@ class Team:
         try:
             self.current_score += int(reward) if reward is not None else 0
         except TypeError:
-            logger.debug(f"Could not parse int for reward \"{reward}\" of type {type(reward)} in team \"{self.name}\"")
+            logger.debug("Could not parse int for reward \"%s\" of type %s in team \"%s\"", reward, type(reward), self.name)
         self.current_answer_score = 0
 
     def reset_answer(self):
@@ -118,32 +207,29 @@ class Quiz:
         self.name = name
         self.title = title
         self.blocks = blocks
+        self._answer_json = None
+        # Set by `validate` or, for compiled quizzes, when loading
+        self._errors = None
+        # Set when loading from the hash of the source, see `digest`
+        self._digest = None
 
     def __getitem__(self, index):
         block_index, question_index = index
-        return self.blocks[block_index].questions[question_index]
+        return self.blocks[block_index][question_index]
 
     def get_next_index(self, index):
         if index is None:
-            if len(self.blocks) > 0 and len(self.blocks[0]) > 0:
-                return (0, 0)
-            else:
-                raise Exception("No more questions")
-
-        block_index, question_index = index
-        block = self.blocks[block_index]
-
-        if len(block) > question_index + 1:
-            return (block_index, question_index + 1)
-
-        # TODO skip empty blocks?
-        if len(self.blocks) <= block_index + 1:
-            raise NoMoreQuestionsException("No more questions")
+            block_index, question_index = 0, -1
+        else:
+            block_index, question_index = index
 
-        block_index += 1
-        if len(self.blocks[block_index]) > 0:
-            return (block_index, 0)
-        raise Exception("No more questions")
+        # Empty blocks are skipped
+        while block_index < len(self.blocks):
+            if len(self.blocks[block_index]) > question_index + 1:
+                return (block_index, question_index + 1)
+            block_index += 1
+            question_index = -1
+        raise NoMoreQuestionsException("No more questions")
 
     def __len__(self):
         return sum(len(block) for block in self.blocks)
@@ -151,12 +237,44 @@ class Quiz:
     def has_blocks(self):
         return len(self.blocks) > 1
 
+    def validate(self):
+        """Return a list of all problems of the quiz, each naming the question
+
+        Quizzes don't change, they are only checked once.
+        """
+        if self._errors is None:
+            self._errors = self._validate()
+        return self._errors
+
+    def _validate(self):
+        # Empty blocks are fine, they are skipped
+        errors = []
+        for block_index, block in enumerate(self.blocks):
+            for question_index, question in enumerate(block.questions):
+                for error in question.validate():
+                    errors.append(f"Question {block_index + 1}.{question_index + 1} ({question.title}): {error}")
+        return errors
+
+    @property
+    def digest(self):
+        """Content hash of the quiz
+
+        Taken from the raw bytes the quiz was loaded from where known, so the
+        questions don't need to be built for it.
+        """
+        if self._digest is None:
+            self._digest = _hash(json.dumps(self.to_answer_json()).encode("utf8"))
+        return self._digest
+
     def to_answer_json(self):
-        return {
-            "name": self.name,
-            "title": self.title,
-            "blocks": [block.to_answer_json() for block in self.blocks],
-        }
+        # Quizzes don't change, the json is built once
+        if self._answer_json is None:
+            self._answer_json = {
+                "name": self.name,
+                "title": self.title,
+                "blocks": [block.to_answer_json() for block in self.blocks],
+            }
+        return self._answer_json
 
     @classmethod
     def from_json(cls, data):
@@ -167,21 +285,55 @@ class Quiz:
         return Quiz(name, title, blocks)
 
     @classmethod
-    def from_path(cls, path):
-        with open(path) as f:
-            return cls.from_json(json.load(f))
+    def from_path(cls, path, sample=True):
+        """Load a quiz file
+
+        Quizzes drawn from a question bank are sampled, unless `sample` is
+        false, then their `BankQuizSpec` is returned.
+        """
+        from .compiled import load_compiled
+
+        # Use the compiled quiz if it is up to date
+        quiz = load_compiled(path)
+        if quiz is not None:
+            return quiz
+
+        with open(path, "rb") as f:
+            raw = f.read()
+        data = json.loads(raw)
+
+        if "bank" in data:
+            from .bank import BankQuizSpec
+            spec = BankQuizSpec.from_json(data, Path(path).parent)
+            return spec.sample() if sample else spec
+        quiz = cls.from_json(data)
+        quiz._digest = _hash(raw)
+        return quiz
 
 
 class QuestionBlock:
-    def __init__(self, title, questions):
+    def __init__(self, title, questions, decode=None):
         self.title = title
-        self.questions = questions
+        self._questions = list(questions)
+        # If given, `questions` are records only decoded to a `Question` once accessed
+        self._decode = decode
+
+    @property
+    def questions(self):
+        if self._decode is not None:
+            for index in range(len(self._questions)):
+                self[index]
+            self._decode = None
+        return self._questions
 
     def __len__(self):
-        return len(self.questions)
+        return len(self._questions)
 
     def __getitem__(self, index):
-        return self.questions[index]
+        question = self._questions[index]
+        if self._decode is not None and not isinstance(question, Question):
+            question = self._questions[index] = self._decode(question)
+        return question
 
     @classmethod
     def from_json(cls, data):
@@ -198,13 +350,74 @@ class QuestionBlock:
 
 
 class Question:
-    def __init__(self, title, renderer, answers, guess_min=None, guess_max=None, guess_start=None):
+    def __init__(self, title, renderer, answers, guess_min=None, guess_max=None, guess_start=None, guess_target=None,
+                 time=None):
         self.title = title
         self.renderer = renderer
         self.answers = answers
+        # Seconds the teams have to answer, untimed if `None`
+        self.time = time
         self.guess_min = guess_min
         self.guess_max = guess_max
         self.guess_start = guess_start
+        self.guess_target = guess_target if guess_target is not None else self._parse_guess_target()
+        # Questions are shared by games and never change, so these are built once
+        self._correct_mask = None
+        self._json = None
+        self._answer_json = None
+
+    @property
+    def correct_mask(self):
+        """Which of the answers are correct"""
+        if self._correct_mask is None:
+            self._correct_mask = np.array([answer.correct for answer in self.answers], dtype=bool)
+        return self._correct_mask
+
+    def correct_mask_in(self, order=None):
+        """Which of the answers in the order shown to the teams are correct"""
+        return self.correct_mask if order is None else self.correct_mask[order]
+
+    def shuffled(self):
+        """A random order of the answers, see `to_json`"""
+        return sample(range(len(self.answers)), len(self.answers))
+
+    @staticmethod
+    def _ordered(data, order):
+        if order is None:
+            return data
+        answers = data["answers"]
+        return {**data, "answers": [answers[index] for index in order]}
+
+    def _parse_guess_target(self):
+        if self.renderer != "guess" or not self.answers:
+            return None
+        try:
+            return float(self.answers[0].kwargs["text"])
+        except (KeyError, TypeError, ValueError):
+            return None
+
+    def validate(self):
+        """Return a list of problems that would break this question in a game"""
+        errors = []
+        if self.renderer not in RENDERERS:
+            errors.append(f"Unknown renderer \"{self.renderer}\"")
+        elif self.renderer == "base":
+            if not self.answers:
+                errors.append("No answers given")
+            elif not any(answer.correct for answer in self.answers):
+                errors.append("No answer is marked as correct")
+        elif self.renderer == "guess":
+            if self.guess_target is None:
+                errors.append("The text of the first answer must be a number")
+            try:
+                if float(self.guess_min) > float(self.guess_max):
+                    errors.append("guess_min is larger than guess_max")
+            except (TypeError, ValueError):
+                errors.append("guess_min and guess_max must be numbers")
+        if self.time is not None and (not isinstance(self.time, (int, float)) or isinstance(self.time, bool)
+                                      or not math.isfinite(self.time) or self.time <= 0):
+            errors.append("time must be a positive number of seconds")
+        return errors
 
     def __str__(self):
         return f"Question({self.title})"
@@ -221,35 +434,40 @@ class Question:
                 title, renderer, answers,
                 guess_min=data.get("guess_min", 0),
                 guess_max=data.get("guess_max", 10000),
-                guess_start=data.get("guess_start", 0)
+                guess_start=data.get("guess_start", 0),
+                time=data.get("time"),
             )
-        return Question(title, renderer, answers)
-
-    def to_json(self):
-        if self.renderer == "guess":
-            return {
+        return Question(title, renderer, answers, time=data.get("time"))
+
+    def to_json(self, order=None):
+        """The question without its solution, answers in `order` if given"""
+        if self._json is None:
+            if self.renderer == "guess":
+                self._json = {
+                    "title": self.title,
+                    "renderer": self.renderer,
+                    "min": self.guess_min,
+                    "max": self.guess_max,
+                    "start": self.guess_start,
+                    "answers": [],
+                }
+            else:
+                self._json = {
+                    "title": self.title,
+                    "renderer": self.renderer,
+                    "answers": [answer.to_json() for answer in self.answers],
+                }
+        # The answer of guess questions isn't shown
+        return self._json if self.renderer == "guess" else self._ordered(self._json, order)
+
+    def to_answer_json(self, order=None):
+        if self._answer_json is None:
+            self._answer_json = {
                 "title": self.title,
                 "renderer": self.renderer,
-                "min": self.guess_min,
-                "max": self.guess_max,
-                "start": self.guess_start,
-                "answers": [],
+                "answers": [answer.to_answer_json() for answer in self.answers],
             }
-        return {
-            "title": self.title,
-            "renderer": self.renderer,
-            "answers": [answer.to_json() for answer in self.answers],
-        }
-
-    def to_answer_json(self):
-        return {
-            "title": self.title,
-            "renderer": self.renderer,
-            "answers": [answer.to_answer_json() for answer in self.answers],
-        }
-
-    def shuffle(self):
-        shuffle(self.answers)
+        return self._ordered(self._answer_json, order)
 
 
 class Answer:
@@ -277,16 +495,71 @@ class Game:
         self.question_state = None
         self.screen_state = ScreenStates.SETUP
         self.questions = questions
-        self.teams = []
-        self.screens = []
-        self.gamemasters = []
+        # Indexed by session id (`cookie`), dicts keep the join order
+        self.team_store = TeamStore()
+        self.emotions = EmotionWindow()
+        self._teams = {}
+        self._team_names = {}
+        self._screens = {}
+        self._gamemasters = {}
+        # Session ids that left, their tokens are no longer accepted
+        self.revoked = set()
         self.current_question_index = None
+        # Unix time at which the current question is scored, see `timers`
+        self.deadline = None
         self.scorer = Scorer()
+        self.version = 0
+        # The order the answers of each asked question are shown in, by question index
+        self.orders = {}
+        self.last_activity = time.monotonic()
+        self._changed = None
+        self.journal = None
+
+    def record(self, action, *args):
+        """Write a state changing action to the journal if there is one"""
+        if self.journal is not None:
+            self.journal.record(action, *args)
+
+    def touch(self):
+        """Mark the game state as changed and wake up waiting clients"""
+        self.version += 1
+        self.last_activity = time.monotonic()
+        if self._changed is not None:
+            self._changed.set()
+            self._changed = None
+
+    async def wait_for_change(self, version, timeout=None):
+        """Wait until the game state moves past `version`
+
+        Returns `True` if the state changed before the timeout passed.
+        """
+        if self.version != version:
+            return True
+
+        if self._changed is None:
+            self._changed = asyncio.Event()
+        try:
+            await asyncio.wait_for(self._changed.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        return self.version != version
 
     @property
     def active(self):
         return self.game_state != GameStates.END
 
+    @property
+    def teams(self):
+        return self._teams.values()
+
+    @property
+    def screens(self):
+        return self._screens.values()
+
+    @property
+    def gamemasters(self):
+        return self._gamemasters.values()
+
     @property
     def name(self):
         return self.questions.name
@@ -300,12 +573,13 @@ class Game:
         if self.current_question is None:
             return None
 
+        order = self.current_order
         if self.question_state == QuestionStates.ASK:
-            return self.current_question.to_json()
+            return self.current_question.to_json(order)
         elif self.question_state == QuestionStates.ANSWER:
-            return self.current_question.to_answer_json()
+            return self.current_question.to_answer_json(order)
         elif self.question_state == QuestionStates.SCORE:
-            return self.current_question.to_json()
+            return self.current_question.to_json(order)
         raise Exception("Unkown state")
 
     @property
@@ -314,24 +588,26 @@ class Game:
             return None
         # TODO different modes here?
         if self.question_state == QuestionStates.ANSWER:
-            return {team.name: team.current_answer for team in self.teams}
+            return self.team_store.column_data(self.team_store.answers)
 
     @property
     def current_answer_score_data(self):
         if self.question_state == QuestionStates.SCORE:
-            return {team.name: team.current_answer_score for team in self.teams}
+            return self.team_store.answer_score_data()
 
     @property
     def gamemaster_data(self):
-        question_data = self.current_question.to_answer_json() if self.current_question else None
-        guess_data = {team.name: team.current_answer for team in self.teams}
+        question_data = self.current_question.to_answer_json(self.current_order) if self.current_question else None
+        guess_data = self.team_store.column_data(self.team_store.answers)
 
         keys = ["key", "active", "team_count", "game_state", "title", "name",
             "question_count", "current_question_index", "question_state", "screen_state",
-            "guess_data", "emotion_data", "score_data", "current_answer_score_data",
+            "current_answer_score_data", "answered_count", "answer_counts", "emotion_counts", "deadline",
         ]
         kwargs = {key: getattr(self, key) for key in keys}
 
+        # The quiz is also served separately by its hash (see `views.quiz_view`),
+        # the shipped frontend bundle still reads it from here until it's rebuilt
         return {
             **kwargs,
             "questions": self.questions.to_answer_json(),
@@ -341,13 +617,35 @@ class Game:
             "guess_data": guess_data,
         }
 
+    @property
+    def leaderboard_data(self):
+        """The top teams, the full ranking is paged with `leaderboard`"""
+        return self.leaderboard()
+
+    def leaderboard(self, offset=0, limit=LEADERBOARD_TOP):
+        store = self.team_store
+        return {
+            "total": len(store.leaderboard),
+            "offset": offset,
+            "entries": store.ranking(store.leaderboard.rows(offset, offset + limit)),
+        }
+
     @property
     def emotion_data(self):
-        return {team.name: team.current_emotion for team in self.teams}
+        return self.team_store.column_data(self.team_store.emotions)
+
+    @property
+    def emotion_counts(self):
+        """How often each emotion was shown lately, see `EmotionWindow`"""
+        return self.emotions.data()
+
+    def expire_emotions(self, now=None):
+        if self.emotions.expire(now):
+            self.touch()
 
     @property
     def score_data(self):
-        return {team.name: team.current_score for team in self.teams}
+        return self.team_store.column_data(self.team_store.score[:self.team_store.size])
 
     @classmethod
     def get_active_games(cls):
@@ -362,29 +660,59 @@ class Game:
         return cls.games[key]
 
     def get_team_by_cookie(self, cookie):
-        for team in self.teams:
-            if team.cookie == cookie:
-                return team
-        raise KeyError("Team with that cookie not found")
+        try:
+            return self._teams[cookie]
+        except KeyError:
+            raise KeyError("Team with that cookie not found")
+
+    def get_team_by_name(self, name):
+        try:
+            return self._team_names[name.casefold()]
+        except KeyError:
+            raise KeyError("Team with that name not found")
+
+    def has_team(self, team):
+        return self._teams.get(team.cookie) is team
+
+    def has_gamemaster(self, session_id):
+        """Whether the gamemaster session is still part of the game"""
+        return session_id in self._gamemasters and session_id not in self.revoked
 
     def get_gamemaster_by_cookie(self, cookie):
-        for gamemaster in self.gamemasters:
-            if gamemaster.cookie == cookie:
-                return gamemaster
-        raise KeyError("Team with that cookie not found")
+        try:
+            return self._gamemasters[cookie]
+        except KeyError:
+            raise KeyError("Gamemaster with that cookie not found")
+
+    def get_screen_by_cookie(self, cookie):
+        try:
+            return self._screens[cookie]
+        except KeyError:
+            raise KeyError("Screen with that cookie not found")
 
     @classmethod
     def add_game(cls, game):
         if game.key in cls.games:
-            raise Exception("Game already exists")
+            raise GameAlreadyExistsException(f"Game \"{game.key}\" already exists")
         cls.games[game.key] = game
 
+    @classmethod
+    def remove_game(cls, game):
+        del cls.games[game.key]
+
     @property
     def current_question(self):
         if self.current_question_index is None:
             return None
         return self.questions[self.current_question_index]
 
+    @property
+    def current_order(self):
+        """The order the answers of the current question are shown in, `None` if unshuffled"""
+        if self.current_question_index is None:
+            return None
+        return self.orders.get(tuple(self.current_question_index))
+
     @property
     def question_count(self):
         return len(self.questions)
@@ -393,23 +721,49 @@ class Game:
     def team_count(self):
         return len(self.teams)
 
-    def ask_next_question(self):
+    def ask_next_question(self, order=None):
         self.current_question_index = self.questions.get_next_index(self.current_question_index)
         self.question_state = QuestionStates.ASK
+        self.deadline = None
 
-        # Reset team questions
-        for team in self.teams:
-            team.reset_answer()
+        # Shuffle the answers for this game only
+        if order is None:
+            order = self.current_question.shuffled()
+        self.orders[tuple(self.current_question_index)] = order
 
-        # Shuffle question
-        self.current_question.shuffle()
+        # Reset team questions
+        self.reset_answers()
+        self.record("ask_next_question", order)
+        self.touch()
 
     def show_question(self, index):
         self.current_question_index = index
 
         self.question_state = QuestionStates.ASK
-        for team in self.teams:
-            team.reset_answer()
+        self.deadline = None
+        self.reset_answers()
+        self.record("show_question", index)
+        self.touch()
+
+    def reset_answers(self):
+        """Clear the answers of all teams and aggregate those to the current question"""
+        question = self.current_question
+        if question.renderer == "guess":
+            self.team_store.reset_answers(target=question.guess_target)
+        else:
+            self.team_store.reset_answers(options=len(question.answers))
+
+    @property
+    def answered_count(self):
+        """Number of teams that answered the current question"""
+        return self.team_store.aggregate.answered
+
+    @property
+    def answer_counts(self):
+        """Number of answers per option of the current question"""
+        if self.current_question is None or self.current_question.renderer == "guess":
+            return None
+        return self.team_store.aggregate.counts.tolist()
 
     def score_answer(self):
         if self.current_question is None:
@@ -417,54 +771,139 @@ class Game:
         if self.question_state != QuestionStates.ASK:
             raise Exception("Wrong Question State")
         self.question_state = QuestionStates.SCORE
+        self.record("score_answer")
+        self.touch()
 
         # Do the scoring
-        return self.scorer.score(self.current_question, self.teams)
+        start = time.perf_counter()
+        scores = self.scorer.score(self.current_question, self.team_store, self.current_order)
+        metrics.scoring.observe(time.perf_counter() - start)
+        return scores
+
+    def set_deadline(self, deadline):
+        """Score the current question at unix time `deadline`, never if `None`"""
+        if self.question_state != QuestionStates.ASK:
+            raise QuestionNotAskedException("The current question isn't asked")
+        self.deadline = deadline
+        self.record("set_deadline", deadline)
+        self.touch()
+
+    def past_deadline(self, now=None):
+        return self.deadline is not None and (now if now is not None else time.time()) >= self.deadline
 
     def show_answer(self, scores=None):
         if self.current_question is None:
             raise Exception("No question asked")
         self.question_state = QuestionStates.ANSWER
 
+        store = self.team_store
         if scores is None:
-            for team in self.teams:
-                logger.debug("Team %s in Game %s rewarded %s", team.name, self.name, team.current_answer_score)
-                team.reward(team.current_answer_score)
+            rewards = store.current_rewards()
         else:
-            for team in self.teams:
-                logger.debug("Team %s in Game %s rewarded %s", team.name, self.name, team.current_answer_score)
-                team.reward(scores.get(team.name, 0))
+            rewards = np.zeros(store.size, dtype=np.int64)
+            for name, reward in scores.items():
+                team = self._team_names.get(name.casefold())
+                if team is None or team.name != name:
+                    continue
+                try:
+                    rewards[team.index] = int(reward) if reward is not None else 0
+                except (TypeError, ValueError):
+                    logger.debug("Could not parse int for reward \"%s\" of type %s in team \"%s\"", reward, type(reward), name)
+
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Teams in Game %s rewarded %s", self.name, store.column_data(rewards))
+        store.reward(rewards)
+        self.record("show_answer", scores)
+        self.touch()
 
     def set_screen_state(self, state):
         self.screen_state = state
+        self.record("set_screen_state", state.name)
+        self.touch()
 
     def start_game(self):
         self.game_state = GameStates.PLAY
+        self.record("start_game")
+        self.touch()
 
     def end_game(self):
         self.game_state = GameStates.END
+        self.record("end_game")
+        self.touch()
+
+    def check_guess(self, answer):
+        """Raise `InvalidGuessException` if a numeric answer is not finite or
+        outside of the range of the current guess question"""
+        try:
+            value = float(answer)
+        except (TypeError, ValueError):
+            return
+        except OverflowError:
+            raise InvalidGuessException("Guess is out of range")
+        if not math.isfinite(value):
+            raise InvalidGuessException(f"Guess {answer} is not a finite number")
+
+        question = self.current_question
+        if question is not None and question.renderer == "guess":
+            try:
+                low, high = float(question.guess_min), float(question.guess_max)
+            except (TypeError, ValueError):
+                return
+            if not low <= value <= high:
+                raise InvalidGuessException(f"Guess {answer} is not between {question.guess_min} and {question.guess_max}")
+
+    def guess(self, team, answer):
+        if self.question_state != QuestionStates.ASK:
+            return False
+        self.check_guess(answer)
+        team.guess(answer)
+        self.record("guess", team.cookie, answer)
+        self.touch()
+        return True
+
+    def show_emotion(self, team, emotion):
+        team.show_emotion(emotion)
+        if emotion is not None:
+            self.emotions.add(emotion)
+        self.record("show_emotion", team.cookie, emotion)
+        self.touch()
 
     def join_team(self, team):
-        for t in self.teams:
-            if t.name == team.name:
-                raise TeamAlreadyExistsException(f"Team with name \"{team.name}\" already exists")
+        name = team.name.casefold()
+        if name in self._team_names:
+            raise TeamAlreadyExistsException(f"Team with name \"{team.name}\" already exists")
+        self.team_store.add(team)
         self.scorer.init_score([team])
-        self.teams.append(team)
+        self._teams[team.cookie] = team
+        self._team_names[name] = team
+        self.record("join_team", team.address, team.name, team.cookie)
+        self.touch()
 
     def leave_team(self, team):
-        self.teams.remove(team)
+        del self._teams[team.cookie]
+        del self._team_names[team.name.casefold()]
+        self.revoked.add(team.cookie)
+        self.team_store.remove(team)
+        self.record("leave_team", team.cookie)
+        self.touch()
 
     def join_screen(self, screen):
-        self.screens.append(screen)
+        self._screens[screen.cookie] = screen
+        self.record("join_screen", screen.address, screen.cookie)
 
     def leave_screen(self, screen):
-        self.screens.remove(screen)
+        del self._screens[screen.cookie]
+        self.revoked.add(screen.cookie)
+        self.record("leave_screen", screen.cookie)
 
     def join_gamemaster(self, password, gamemaster):
         if password == self.gamemaster_password:
-            self.gamemasters.append(gamemaster)
+            self._gamemasters[gamemaster.cookie] = gamemaster
+            self.record("join_gamemaster", gamemaster.address, gamemaster.cookie)
         else:
             raise WrongPasswordException("Wrong Password for Gamemaster")
 
     def leave_gamemaster(self, gamemaster):
-        self.gamemasters.remove(gamemaster)
+        del self._gamemasters[gamemaster.cookie]
+        self.revoked.add(gamemaster.cookie)
+        self.record("leave_gamemaster", gamemaster.cookie)
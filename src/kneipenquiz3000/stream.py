@@ -0,0 +1,113 @@
+"""
+Push channel for game state updates.
+
+Every game with at least one subscriber gets a `GameStream` which waits for
+the game to change and then hands the new state to all of its subscribers.
+Each role view is serialized once per change, and every subscriber has its
+own small queue so a slow client never holds up the others.
+"""
+import asyncio
+from .logs import logger
+from .views import projection
+from .cache import view_cache, gamemaster_view
+
+
+# Number of pending updates kept per subscriber, older ones are dropped
+SEND_QUEUE_SIZE = 2
+
+
+class Subscriber:
+    def __init__(self, role, team=None, select=None, session_id=None, maxsize=SEND_QUEUE_SIZE):
+        self.role = role
+        self.team = team
+        # Of gamemasters, checked on every push as their view holds the answers
+        self.session_id = session_id
+        # Chooses the view of the game, see `views.projection`
+        self.select = select or projection("team" if role == "team" else "game")
+        self.queue = asyncio.Queue(maxsize)
+        self.dropped = 0
+
+    def push(self, data):
+        """Queue an update, dropping the oldest one if the client lags behind
+
+        Every update carries the full state, so skipping an outdated one
+        loses nothing.
+        """
+        if self.queue.full():
+            self.queue.get_nowait()
+            self.dropped += 1
+        self.queue.put_nowait(data)
+
+    def close(self):
+        self.push(None)
+
+
+class GameStream:
+    def __init__(self, game):
+        self.game = game
+        self.subscribers = set()
+        self.task = None
+
+    def subscribe(self, subscriber):
+        self.subscribers.add(subscriber)
+        self.broadcast([subscriber])
+
+        if self.task is None:
+            self.task = asyncio.ensure_future(self.run())
+
+    def unsubscribe(self, subscriber):
+        self.subscribers.discard(subscriber)
+
+        if not self.subscribers and self.task is not None:
+            self.task.cancel()
+            self.task = None
+            streams.pop(self.game.key, None)
+
+    async def run(self):
+        while True:
+            await self.game.wait_for_change(self.game.version)
+            self.broadcast(list(self.subscribers))
+
+    def broadcast(self, subscribers):
+        for subscriber in subscribers:
+            if subscriber.role == "gamemaster":
+                if not self.game.has_gamemaster(subscriber.session_id):
+                    subscriber.close()
+                    continue
+                subscriber.push(view_cache.get(self.game, "gamemaster", gamemaster_view).body)
+                continue
+
+            if subscriber.role == "team":
+                if not self.game.has_team(subscriber.team):
+                    subscriber.close()
+                    continue
+                entry = view_cache.get(self.game, *subscriber.select(self.game))
+                subscriber.push(entry.team_body(subscriber.team))
+            else:
+                subscriber.push(view_cache.get(self.game, *subscriber.select(self.game)).body)
+
+        logger.debug("Pushed version %s of game %s to %s subscribers", self.game.version, self.game.key, len(subscribers))
+
+
+streams = {}
+
+
+def get_game_stream(game):
+    try:
+        return streams[game.key]
+    except KeyError:
+        stream = streams[game.key] = GameStream(game)
+        return stream
+
+
+def close_game_stream(game):
+    """Disconnect all subscribers of a game, e.g. once it's removed"""
+    stream = streams.pop(game.key, None)
+    if stream is None:
+        return
+
+    for subscriber in stream.subscribers:
+        subscriber.close()
+    if stream.task is not None:
+        stream.task.cancel()
+        stream.task = None
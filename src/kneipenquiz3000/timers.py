@@ -0,0 +1,197 @@
+"""
+Deadlines of timed questions.
+
+A question is timed by `"time": <seconds>` in the quiz file or by the
+`set_deadline` gamemaster action. Once its deadline passed guesses are
+rejected and the question is scored.
+
+The deadlines of all games are kept in one hierarchical timer wheel,
+driven by a single task on the event loop that advances it every `TICK`
+seconds. Each level of the wheel has `SLOTS` buckets, a bucket of level 0
+holds the timers of one tick, one of level 1 those of `SLOTS` ticks and so
+on. Timers move to the lower levels as their time comes closer, so adding,
+cancelling and firing a timer takes constant time however many games are
+running.
+"""
+import math
+import time
+import asyncio
+from .states import Game, QuestionStates
+from .ingest import ingest
+from .logs import logger
+
+
+# Seconds per tick of the wheel
+TICK = 0.05
+SLOT_BITS = 6
+SLOTS = 1 << SLOT_BITS
+# With 4 levels of 64 slots timers up to 64 ** 4 ticks (9 days) ahead fit
+LEVELS = 4
+
+
+class Timer:
+    __slots__ = ("when", "tick", "callback", "args", "cancelled")
+
+    def __init__(self, when, callback, args):
+        self.when = when
+        self.tick = None
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+
+class TimerWheel:
+    def __init__(self, tick=TICK):
+        self.tick = tick
+        self.wheels = [[[] for _ in range(SLOTS)] for _ in range(LEVELS)]
+        # The last tick that was processed, counted from `start`
+        self.current = 0
+        self.start = None
+        self.count = 0
+        self._early = []
+        self._wakeup = None
+
+    def _now(self):
+        return asyncio.get_event_loop().time()
+
+    def call_at(self, when, callback, *args):
+        """Call `callback(*args)` on the loop at unix time `when` (or right after)
+
+        Returns the `Timer`, which can be cancelled.
+        """
+        if not math.isfinite(when):
+            raise ValueError(f"Can't schedule a timer at {when}")
+
+        timer = Timer(when, callback, args)
+        if self.start is None:
+            # Placed once the wheel runs
+            self._early.append(timer)
+        else:
+            self._place(timer)
+        self.count += 1
+        return timer
+
+    def cancel(self, timer):
+        if not timer.cancelled:
+            timer.cancelled = True
+            self.count -= 1
+
+    def _place(self, timer):
+        if not self.count:
+            # The wheel was idle, the skipped ticks were empty
+            self.current = max(self.current, int((self._now() - self.start) / self.tick))
+        loop_when = self._now() + timer.when - time.time()
+        timer.tick = max(self.current + 1, math.ceil((loop_when - self.start) / self.tick))
+        self._insert(timer)
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    def _insert(self, timer):
+        delta = timer.tick - self.current
+        for level in range(LEVELS):
+            if delta < 1 << (SLOT_BITS * (level + 1)):
+                break
+        else:
+            # Too far ahead, parked in the last slot it can reach and moved down from there
+            level = LEVELS - 1
+            delta = (1 << (SLOT_BITS * LEVELS)) - 1
+        slot = ((self.current + delta) >> (SLOT_BITS * level)) & (SLOTS - 1)
+        self.wheels[level][slot].append(timer)
+
+    def _advance(self):
+        self.current += 1
+        tick = self.current
+
+        # Move the timers of the next higher level buckets down, highest first
+        for level in range(LEVELS - 1, 0, -1):
+            if tick & ((1 << (SLOT_BITS * level)) - 1) == 0:
+                wheel = self.wheels[level]
+                slot = (tick >> (SLOT_BITS * level)) & (SLOTS - 1)
+                timers, wheel[slot] = wheel[slot], []
+                for timer in timers:
+                    if not timer.cancelled:
+                        self._insert(timer)
+
+        bucket = self.wheels[0]
+        slot = tick & (SLOTS - 1)
+        timers, bucket[slot] = bucket[slot], []
+        for timer in timers:
+            if timer.cancelled:
+                continue
+            if timer.tick > tick:
+                # Parked too far ahead, see `_insert`
+                self._insert(timer)
+                continue
+            self.cancel(timer)
+            try:
+                timer.callback(*timer.args)
+            except Exception:
+                logger.exception("Timer callback %r failed", timer.callback)
+
+    async def context(self, app):
+        """Cleanup context running the wheel"""
+        async def run():
+            while True:
+                if not self.count:
+                    self._wakeup = asyncio.Event()
+                    await self._wakeup.wait()
+                    self._wakeup = None
+
+                target = int((self._now() - self.start) / self.tick)
+                while self.current < target and self.count:
+                    self._advance()
+                await asyncio.sleep(self.start + (self.current + 1) * self.tick - self._now())
+
+        self.start = self._now()
+        self.current = 0
+        early, self._early = self._early, []
+        for timer in early:
+            if not timer.cancelled:
+                self._place(timer)
+
+        task = asyncio.ensure_future(run())
+        yield
+        task.cancel()
+        self.start = None
+
+
+class Deadlines:
+    """Scores the questions of the games once their deadline passed"""
+    def __init__(self, wheel):
+        self.wheel = wheel
+        self.timers = {}
+
+    def schedule(self, game):
+        """Follow the deadline of a game, call whenever it may have changed"""
+        deadline = game.deadline if game.question_state == QuestionStates.ASK else None
+        timer = self.timers.get(game.key)
+        if timer is not None:
+            if not timer.cancelled and timer.args[1] == deadline:
+                return
+            self.wheel.cancel(timer)
+            del self.timers[game.key]
+
+        if deadline is not None:
+            self.timers[game.key] = self.wheel.call_at(deadline, self._expire, game, deadline)
+
+    def discard(self, game):
+        timer = self.timers.pop(game.key, None)
+        if timer is not None:
+            self.wheel.cancel(timer)
+
+    def _expire(self, game, deadline):
+        timer = self.timers.get(game.key)
+        if timer is not None and timer.args[1] == deadline:
+            del self.timers[game.key]
+        if Game.games.get(game.key) is not game or game.deadline != deadline \
+                or game.question_state != QuestionStates.ASK:
+            return
+
+        # Guesses that came in before the deadline are still pending
+        ingest.flush(game)
+        game.score_answer()
+        logger.info("Time is up for question %s of game %s", game.current_question_index, game.key)
+
+
+wheel = TimerWheel()
+deadlines = Deadlines(wheel)
@@ -0,0 +1,72 @@
+"""
+Signed session tokens.
+
+A token is `<payload>.<signature>`, both urlsafe base64. The payload names
+the game, the role (team, gamemaster, screen) and the id of the session,
+the signature is an HMAC-SHA256 of it with the server secret. Any process
+knowing the secret can check a token without looking anything up, tokens
+of sessions that left their game are rejected through the revocation set
+of the game (`Game.revoked`).
+"""
+import hmac
+import base64
+import hashlib
+import secrets
+
+
+VERSION = "1"
+SIGNATURE_SIZE = 16
+
+
+def _encode(data):
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode("ascii")
+
+
+def _decode(text):
+    return base64.urlsafe_b64decode(text + "=" * (-len(text) % 4))
+
+
+def new_id():
+    """A new session id, unique within a game"""
+    return secrets.token_urlsafe(9)
+
+
+class TokenSigner:
+    def __init__(self, secret=None):
+        self.configure(secret)
+
+    def configure(self, secret=None):
+        """Use `secret` (str or bytes) for signing, a random one if it's `None`"""
+        if secret is None:
+            secret = secrets.token_bytes(32)
+        elif isinstance(secret, str):
+            secret = secret.encode("utf8")
+        self.secret = secret
+
+    def _signature(self, payload):
+        return hmac.new(self.secret, payload, hashlib.sha256).digest()[:SIGNATURE_SIZE]
+
+    def sign(self, game_key, role, session_id):
+        # The game key comes last as the only part that may contain `|`
+        payload = f"{VERSION}|{role}|{session_id}|{game_key}".encode("utf8")
+        return f"{_encode(payload)}.{_encode(self._signature(payload))}"
+
+    def verify(self, token, game_key, role):
+        """Return the session id of a valid token of `role` in the game, else `None`"""
+        payload, _, signature = token.partition(".")
+        try:
+            payload = _decode(payload)
+            signature = _decode(signature)
+        except ValueError:
+            return None
+
+        if not hmac.compare_digest(signature, self._signature(payload)):
+            return None
+
+        version, token_role, session_id, token_game = payload.decode("utf8").split("|", 3)
+        if version != VERSION or token_role != role or token_game != str(game_key):
+            return None
+        return session_id
+
+
+signer = TokenSigner()
@@ -0,0 +1,143 @@
+"""
+Role specific views of a game and their json encoding.
+
+Used by the rest endpoints as well as the push stream, so that both hand
+out exactly the same data.
+"""
+import json
+from enum import Enum
+from .states import ScreenStates
+
+
+GAME_KEYS = (
+    "key", "active", "team_count", "game_state", "title", "name",
+    "question_count", "current_question_index", "question_state", "screen_state", "deadline",
+    "question_data", "guess_data", "emotion_counts", "score_data",
+    "answered_count", "answer_counts", "leaderboard_data",
+    # Read by the shipped frontend bundle until it's rebuilt for `emotion_counts`
+    "emotion_data",
+)
+
+# Teams get the leaderboard and their rank instead of the scores of all teams
+TEAM_GAME_KEYS = tuple(key for key in GAME_KEYS if key != "score_data")
+
+# The compact views (`?view=slim`) only carry what the current screen state shows
+SLIM_BASE_KEYS = (
+    "key", "active", "game_state", "title", "name",
+    "current_question_index", "question_state", "screen_state",
+)
+SLIM_KEYS = {
+    ScreenStates.SETUP: (),
+    ScreenStates.LOBBY: ("team_count", "emotion_counts"),
+    ScreenStates.QUESTION: ("question_data", "deadline", "team_count", "answered_count", "emotion_counts"),
+    ScreenStates.ANSWER: ("question_data", "answer_counts", "guess_data", "emotion_counts"),
+    ScreenStates.SCORE: ("question_data", "leaderboard_data", "emotion_counts"),
+    ScreenStates.FINAL: ("leaderboard_data", "score_data"),
+}
+# Teams have their own answer in the team data
+SLIM_TEAM_SKIP = ("guess_data", "score_data")
+
+TEAM_KEYS = ("active", "name", "current_answer", "current_emotion", "current_score", "rank", "neighbours")
+
+
+def props(item, *keys):
+    return {key: getattr(item, key) for key in keys}
+
+
+def _dump_default(arg):
+    if isinstance(arg, Enum):
+        return arg.name
+    return str(arg)
+
+
+def dump(data):
+    return json.dumps(data, default=_dump_default)
+
+
+def encode(data):
+    return dump(data).encode("utf8")
+
+
+def game_view(game):
+    return props(game, *GAME_KEYS)
+
+
+def team_game_view(game):
+    return props(game, *TEAM_GAME_KEYS)
+
+
+ROLE_VIEWS = {
+    "game": (GAME_KEYS, game_view),
+    "team": (TEAM_GAME_KEYS, team_game_view),
+}
+
+
+def _projected_view(keys):
+    return lambda game: props(game, *keys)
+
+
+def _slim_views(role):
+    keys = ROLE_VIEWS[role][0]
+    views = {}
+    for state, state_keys in SLIM_KEYS.items():
+        state_keys = SLIM_BASE_KEYS + tuple(
+            key for key in state_keys if key in keys and not (role == "team" and key in SLIM_TEAM_SKIP)
+        )
+        views[state] = (f"{role}?view={state.name}", _projected_view(state_keys))
+    return views
+
+
+SLIM_VIEWS = {role: _slim_views(role) for role in ROLE_VIEWS}
+
+
+def projection(role, fields=None, slim=False):
+    """Choose the view of a role, all of it, only `fields` or the slim one
+
+    Returns a function mapping a game to the cache role and the builder of
+    its view. Raises `ValueError` for unknown fields.
+    """
+    keys, build = ROLE_VIEWS[role]
+
+    if fields is not None:
+        unknown = set(fields) - set(keys)
+        if unknown:
+            raise ValueError(f"Unknown fields {', '.join(sorted(unknown))}, known are {', '.join(keys)}")
+        # In the order of the view without duplicates, so the cache has one
+        # entry per set of fields. The team data is appended to the encoded
+        # view, which can't be empty.
+        selected = tuple(key for key in keys if key in fields)
+        if not selected:
+            raise ValueError("No fields selected")
+        view = (f"{role}?fields={','.join(selected)}", _projected_view(selected))
+        return lambda game: view
+
+    if slim:
+        views = SLIM_VIEWS[role]
+        return lambda game: views[game.screen_state]
+
+    return lambda game: (role, build)
+
+
+def team_data(team):
+    return props(team, *TEAM_KEYS)
+
+
+def team_view(game, team):
+    return {**team_game_view(game), "team_data": team_data(team)}
+
+
+def quiz_view(game):
+    return game.questions.to_answer_json()
+
+
+def encode_team_fragment(team):
+    return b', "team_data": ' + encode(team_data(team)) + b"}"
+
+
+def encode_team_view(encoded_game_view, team):
+    """Append the team fragment to an already encoded game view
+
+    This way the shared part of a team view is only serialized once for all
+    teams of a game.
+    """
+    return encoded_game_view[:-1] + encode_team_fragment(team)